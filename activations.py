@@ -1,5 +1,5 @@
 __author__ = 'madhumathi'
-import theano.tensor as T
+from deepLearningLibrary.backend import T
 
 epsilon = 10e-5
 ''' Set of activation functions '''
@@ -0,0 +1,321 @@
+import numpy as np
+from deepLearningLibrary.layers import *
+from deepLearningLibrary.connections import *
+from deepLearningLibrary.toposort import *
+
+'''
+Static estimates for a network, computed from the layer shapes and connection configuration only. They need neither
+compiled functions nor initialized weights, so they can be used before Network.compile (e.g. to choose the
+mini-batch size).
+'''
+
+def connectionParameterCount(connection):
+    '''
+    :return: number of weights of the connection, as created by its initializeWeights
+    '''
+    if isinstance(connection,DenseConnection) or isinstance(connection,RecurrentConnection):
+        return connection.fromLayer.numOfNeurons*connection.targetNeurons + connection.targetNeurons
+    elif isinstance(connection,OneToOneConnection):
+        return connection.fromLayer.numOfNeurons
+    elif isinstance(connection,ConvolutedConnection):
+        return int(np.prod(connection.filter_shape)) + connection.filter_shape[0]
+    return 0
+
+
+def layerParameterCount(layer):
+    '''
+    :return: (trained parameters, state that is not trained e.g. running statistics) of the layer itself
+    '''
+    if isinstance(layer,BatchNormLayer):
+        return 2*layer.numOfChannels, 2*layer.numOfChannels
+    return 0, 0
+
+
+def layerActivationCount(layer):
+    '''
+    :return: number of values per example kept for the backward pass: the output of every incoming connection,
+             the aggregated input, the output and the dropout mask
+    '''
+    if isinstance(layer,InputLayer):
+        return layer.numOfNeurons
+    count = sum([connection.targetNeurons for connection in layer.inConnections + layer.recurrentInConnections])
+    count += 2*layer.numOfNeurons
+    if isinstance(layer,BatchNormLayer):
+        # normalized input
+        count += layer.numOfNeurons
+    if layer.dropout is not None:
+        count += layer.numOfNeurons
+    return count
+
+
+def memoryReport(layers, batchSize, dtype='float32', optimizerSlots=0, accumulation_steps=1):
+    '''
+    Estimate the training memory of a network, per layer. The weights of a connection are counted for the layer it
+    ends at.
+    :param layers: layers of the network
+    :param batchSize: mini-batch size
+    :param dtype: dtype of the weights and activations (theano.config.floatX)
+    :param optimizerSlots: number of values the optimizer keeps per trained parameter (0 for SGD, 1 for momentum)
+    :param accumulation_steps: gradient accumulation (see Network.fit) keeps one more buffer per trained parameter
+    :return: dictionary with 'layers', a list of per layer dictionaries, and 'total', all sizes in bytes
+    '''
+    itemSize = np.dtype(dtype).itemsize
+    order = [layer for level in topologicalLevels(constructGraph(layers)) for layer in level]
+
+    report = {'batchSize': batchSize, 'dtype': np.dtype(dtype).name, 'layers': []}
+    for layer in order:
+        numParams, numState = layerParameterCount(layer)
+        numTrainable = 0
+        if layer.trainable:
+            numTrainable += numParams
+        for connection in layer.inConnections + layer.recurrentInConnections:
+            count = connectionParameterCount(connection)
+            numParams += count
+            if connection.trainable and layer.trainable:
+                numTrainable += count
+
+        optimizerState = optimizerSlots*numTrainable
+        if accumulation_steps > 1:
+            optimizerState += numTrainable
+
+        report['layers'].append({'name': layer.name,
+                                 'parameters': (numParams + numState)*itemSize,
+                                 'activations': batchSize*layerActivationCount(layer)*itemSize,
+                                 'gradients': numTrainable*itemSize,
+                                 'optimizerState': optimizerState*itemSize,
+                                 'checkpoint': layer.checkpoint})
+
+    report['total'] = {}
+    for key in ['parameters', 'gradients', 'optimizerState']:
+        report['total'][key] = sum([layerReport[key] for layerReport in report['layers']])
+    report['total']['activations'] = peakActivations(report['layers'])
+    report['total']['total'] = sum(report['total'].values())
+    return report
+
+
+def peakActivations(layerReports):
+    '''
+    Without checkpoints all activations are kept. With checkpoints (see Network.checkpointReplacements) the
+    segments up to each checkpoint are recomputed by the backward pass, so only the network input, the checkpoints,
+    the layers after the last checkpoint and the largest recomputed segment are held at the same time
+    '''
+    if not any([layerReport['checkpoint'] for layerReport in layerReports]):
+        return sum([layerReport['activations'] for layerReport in layerReports])
+
+    kept, largestSegment, segment = layerReports[0]['activations'], 0, 0
+    for layerReport in layerReports[1:]:
+        if layerReport['checkpoint']:
+            kept += layerReport['activations']
+            largestSegment = max(largestSegment, segment)
+            segment = 0
+        else:
+            segment += layerReport['activations']
+    # What follows the last checkpoint is not recomputed
+    return kept + segment + largestSegment
+
+
+def largestBatchSize(layers, memoryBudget, dtype='float32', optimizerSlots=0, accumulation_steps=1):
+    '''
+    :param memoryBudget: bytes available for training
+    :return: largest mini-batch size whose estimated memory fits into memoryBudget, 0 if none does
+    '''
+    # The estimate is linear in the batch size
+    fixed = memoryReport(layers, 0, dtype, optimizerSlots, accumulation_steps)['total']['total']
+    perExample = memoryReport(layers, 1, dtype, optimizerSlots, accumulation_steps)['total']['total'] - fixed
+    if memoryBudget < fixed + perExample:
+        return 0
+    return int((memoryBudget - fixed) // perExample)
+
+
+def formatBytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024.0:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+    return '%.1f TB' % size
+
+
+def printMemoryReport(report):
+    columns = ['parameters', 'activations', 'gradients', 'optimizerState']
+    print('Memory estimate for mini-batch size {0} ({1})'.format(report['batchSize'], report['dtype']))
+    print('{0:<40}'.format('layer') + ''.join(['{0:>16}'.format(column) for column in columns]))
+    for layerReport in report['layers']:
+        print('{0:<40}'.format(str(layerReport['name'])[:40]) +
+              ''.join(['{0:>16}'.format(formatBytes(layerReport[column])) for column in columns]))
+    print('{0:<40}'.format('total (peak activations)') +
+          ''.join(['{0:>16}'.format(formatBytes(report['total'][column])) for column in columns]))
+    print('Estimated training memory: {0}'.format(formatBytes(report['total']['total'])))
+
+
+def linearCost(inputs, weights, outputs, macsPerOutput, needsInputGradient, needsWeightGradient):
+    '''
+    Cost of a linear operation (matrix product or convolution) with its bias, in FLOPs and values moved. The
+    backward pass computes the gradient of the input and of the weights, each as expensive as the forward product
+    :param inputs: values read from the incoming layer
+    :param weights: weights and bias
+    :param outputs: values written
+    :param macsPerOutput: multiply-adds per output value
+    '''
+    forwardFlops = 2*outputs*macsPerOutput + outputs
+    backwardFlops, backwardValues = 0, outputs + weights
+    if needsInputGradient:
+        backwardFlops += 2*outputs*macsPerOutput
+        backwardValues += inputs
+    if needsWeightGradient:
+        backwardFlops += 2*outputs*macsPerOutput + outputs
+        backwardValues += inputs + weights
+    return forwardFlops, backwardFlops, inputs + weights + outputs, backwardValues
+
+
+def connectionCost(connection, batchSize):
+    '''
+    :return: (forward FLOPs, backward FLOPs, forward values moved, backward values moved) of the connection for a
+             mini-batch of batchSize
+    '''
+    inputs = batchSize*connection.fromLayer.numOfNeurons
+    outputs = batchSize*connection.targetNeurons
+    # Nothing upstream of the network input needs its gradient
+    needsInputGradient = not isinstance(connection.fromLayer,InputLayer)
+    needsWeightGradient = connection.trainable and connection.toLayer.trainable
+    weights = connectionParameterCount(connection)
+
+    if isinstance(connection,DenseConnection) or isinstance(connection,RecurrentConnection):
+        return linearCost(inputs, weights, outputs, connection.fromLayer.numOfNeurons,
+                          needsInputGradient, needsWeightGradient)
+    elif isinstance(connection,ConvolutedConnection):
+        # Every output value is a dot product over one filter (depth, height, width)
+        return linearCost(inputs, weights, outputs, int(np.prod(connection.filter_shape[1:])),
+                          needsInputGradient, needsWeightGradient)
+    elif isinstance(connection,OneToOneConnection):
+        backwardFlops = 0
+        if needsInputGradient:
+            backwardFlops += outputs
+        if needsWeightGradient:
+            backwardFlops += 2*outputs
+        return outputs, backwardFlops, inputs + weights + outputs, outputs + inputs + 2*weights
+    elif isinstance(connection,MaxPoolingConnection):
+        # One comparison per input value, the backward pass routes every output gradient to its maximum
+        return inputs, inputs, inputs + outputs, 2*inputs + outputs
+    return 0, 0, 0, 0
+
+
+def layerCost(layer, batchSize):
+    '''
+    Elementwise work of the layer itself: aggregation of the incoming connections, input normalization, batch
+    normalization, the pass function and dropout. Every elementwise pass reads and writes each value once forward,
+    and reads two values and writes one backward. The pass function is counted as one FLOP per value, whatever
+    it is
+    :return: (forward FLOPs, backward FLOPs, forward values moved, backward values moved)
+    '''
+    values = batchSize*layer.numOfNeurons
+    if isinstance(layer,InputLayer):
+        passes = 0
+        if layer.scale is not None:
+            passes += 1
+        if layer.mean is not None:
+            passes += 1
+        return passes*values, 0, 2*passes*values, 0
+
+    # Aggregation reads every incoming connection output and writes the input, summing adds into a zero
+    # initialized input while concatenation only copies. Recurrent inputs are always added
+    incoming = batchSize*sum([connection.targetNeurons for connection in
+                              layer.inConnections + layer.recurrentInConnections])
+    forwardFlops = len(layer.recurrentInConnections)*values
+    if layer.aggregate_method != 'concat':
+        forwardFlops += len(layer.inConnections)*values
+
+    passes = 1
+    if isinstance(layer,BatchNormLayer) and not layer.folded:
+        # mean, variance, centering, scaling and shift
+        forwardFlops += 7*values
+        passes += 4
+    forwardFlops += values
+    if layer.dropout is not None:
+        # mask sampling and multiplication
+        forwardFlops += 2*values
+        passes += 1
+
+    forwardValues = incoming + values + 2*passes*values
+    backwardValues = incoming + values + 3*passes*values
+    return forwardFlops, 2*forwardFlops, forwardValues, backwardValues
+
+
+def costReport(layers, batchSize, dtype='float32'):
+    '''
+    Estimate the FLOPs and bytes moved of one training step, per layer. The cost of a connection is counted for the
+    layer it ends at. Bytes moved count every value read or written once, ignoring caches and fusion of operations,
+    so they are an upper bound for a memory-bound step
+    :param layers: layers of the network
+    :param batchSize: mini-batch size
+    :param dtype: dtype of the weights and activations (theano.config.floatX)
+    :return: dictionary with 'layers', a list of per layer dictionaries, and 'total'
+    '''
+    itemSize = np.dtype(dtype).itemsize
+    order = [layer for level in topologicalLevels(constructGraph(layers)) for layer in level]
+    keys = ['forwardFlops', 'backwardFlops', 'forwardBytes', 'backwardBytes']
+
+    report = {'batchSize': batchSize, 'dtype': np.dtype(dtype).name, 'layers': []}
+    for layer in order:
+        costs = [layerCost(layer, batchSize)] + [connectionCost(connection, batchSize) for connection in
+                                                  layer.inConnections + layer.recurrentInConnections]
+        forwardFlops, backwardFlops, forwardValues, backwardValues = [sum(column) for column in zip(*costs)]
+        report['layers'].append({'name': layer.name,
+                                 'forwardFlops': forwardFlops,
+                                 'backwardFlops': backwardFlops,
+                                 'forwardBytes': forwardValues*itemSize,
+                                 'backwardBytes': backwardValues*itemSize})
+
+    report['total'] = dict((key, sum([layerReport[key] for layerReport in report['layers']])) for key in keys)
+    report['total']['flops'] = report['total']['forwardFlops'] + report['total']['backwardFlops']
+    report['total']['bytes'] = report['total']['forwardBytes'] + report['total']['backwardBytes']
+    report['total']['intensity'] = report['total']['flops'] / float(max(report['total']['bytes'], 1))
+    return report
+
+
+def roofline(report, stepTime, peakFlops=None, peakBandwidth=None):
+    '''
+    Compare the estimated cost of a training step with its measured time
+    :param stepTime: measured seconds per training step, for the batch size of the report
+    :param peakFlops: peak FLOP/s of the machine, optional
+    :param peakBandwidth: peak memory bandwidth in bytes/s, optional
+    :return: dictionary with the achieved FLOP/s and bytes/s, and with both peaks the attainable FLOP/s at the
+             arithmetic intensity of the step, the fraction of it achieved and whether the step is memory bound
+    '''
+    total = report['total']
+    result = {'stepTime': stepTime,
+              'achievedFlops': total['flops'] / stepTime,
+              'achievedBandwidth': total['bytes'] / stepTime,
+              'intensity': total['intensity']}
+    if peakFlops is not None and peakBandwidth is not None:
+        result['attainableFlops'] = min(peakFlops, total['intensity']*peakBandwidth)
+        result['efficiency'] = result['achievedFlops'] / result['attainableFlops']
+        result['memoryBound'] = total['intensity']*peakBandwidth < peakFlops
+    return result
+
+
+def formatCount(count):
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if count < 1000.0:
+            return '%.1f %s' % (count, unit)
+        count /= 1000.0
+    return '%.1f P' % count
+
+
+def printCostReport(report, rooflineResult=None):
+    columns = ['forwardFlops', 'backwardFlops', 'forwardBytes', 'backwardBytes']
+    print('Cost estimate of a training step for mini-batch size {0} ({1})'.format(report['batchSize'],
+                                                                                   report['dtype']))
+    print('{0:<40}'.format('layer') + ''.join(['{0:>16}'.format(column) for column in columns]))
+    for layerReport in report['layers'] + [dict(report['total'], name='total')]:
+        print('{0:<40}'.format(str(layerReport['name'])[:40]) +
+              ''.join(['{0:>16}'.format(formatCount(layerReport[column]) + 'FLOP') for column in columns[:2]]) +
+              ''.join(['{0:>16}'.format(formatBytes(layerReport[column])) for column in columns[2:]]))
+    print('Arithmetic intensity: {0:.2f} FLOP/byte'.format(report['total']['intensity']))
+    if rooflineResult is not None:
+        print('Measured {0:.4f} s per step: {1}FLOP/s, {2}/s'.format(
+            rooflineResult['stepTime'], formatCount(rooflineResult['achievedFlops']),
+            formatBytes(rooflineResult['achievedBandwidth'])))
+        if 'attainableFlops' in rooflineResult:
+            print('Attainable at this intensity: {0}FLOP/s ({1} bound), {2:.1%} achieved'.format(
+                formatCount(rooflineResult['attainableFlops']),
+                'memory' if rooflineResult['memoryBound'] else 'compute', rooflineResult['efficiency']))
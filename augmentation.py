@@ -0,0 +1,232 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import Queue
+import cPickle
+import numpy as np
+from numpy.lib.format import open_memmap
+from deepLearningLibrary.exceptions import *
+
+'''
+Data augmentation in background worker processes. Workers augment training mini-batches of (channels, height,
+width) images and write them into a ring of shared memory buffers, so the training loop only picks up finished
+mini-batches while the next ones are being prepared.
+
+As for asynchronous validation (validation.py), the workers are fresh interpreters, not forks of the trainer: forking
+after BLAS has started its thread pool can deadlock the child. The training data and the ring are memory-mapped
+files in a temporary directory that the workers open by name, only the tasks and the finished slots go over their
+stdin and stdout.
+'''
+
+def randomCrop(x, padding, mode, rng):
+    '''
+    Pad every image by padding pixels on each side and cut it back to its size at a random offset
+    :param x: images (minibatch, channels, height, width)
+    :param mode: numpy.pad mode, 'reflect' for crops, 'constant' (zeros) for shifts
+    '''
+    if padding == 0:
+        return x
+    height, width = x.shape[2], x.shape[3]
+    padded = np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)), mode=mode)
+    offsets = rng.randint(0, 2*padding + 1, size=(x.shape[0], 2))
+    return np.array([image[:, top:top+height, left:left+width]
+                     for image, (top, left) in zip(padded, offsets)], dtype=x.dtype)
+
+
+class Augmentation(object):
+    '''
+    Random transformations applied independently to every image of a mini-batch
+    '''
+    def __init__(self, crop=0, shift=0, flip=False, noise=0.0):
+        '''
+        :param crop: Random crops from the image reflected at its borders by up to this many pixels
+        :param shift: Random translations by up to this many pixels, filled with zeros
+        :param flip: Flip half of the images horizontally
+        :param noise: Standard deviation of added Gaussian noise
+        '''
+        self.crop = crop
+        self.shift = shift
+        self.flip = flip
+        self.noise = noise
+
+    def spatial(self):
+        return self.crop > 0 or self.shift > 0 or self.flip
+
+    def apply(self, x, rng):
+        '''
+        :param x: images (minibatch, channels, height, width)
+        :param rng: numpy RandomState
+        :return: augmented images
+        '''
+        x = randomCrop(x, self.crop, 'reflect', rng)
+        x = randomCrop(x, self.shift, 'constant', rng)
+        if self.flip:
+            flipped = rng.rand(x.shape[0]) < 0.5
+            x[flipped] = x[flipped][:, :, :, ::-1]
+        if self.noise > 0:
+            noisy = x + rng.normal(0.0, self.noise, size=x.shape)
+            if np.issubdtype(x.dtype, np.integer):
+                # Compact (e.g. uint8) inputs stay in their dtype, the noise is in their units
+                limits = np.iinfo(x.dtype)
+                noisy = np.clip(np.rint(noisy), limits.min, limits.max)
+            x = np.asarray(noisy, dtype=x.dtype)
+        return x
+
+
+def augmentationWorker(tasks, ready):
+    '''
+    :param tasks: file the setup, then the tasks (slot, step, mini-batch index) and finally None are read from
+    :param ready: file the slots are written to once their mini-batch is in the ring
+    '''
+    directory, imageShape, batchSize, numOutputs, augmentation, seed = cPickle.load(tasks)
+    data_x = np.load(os.path.join(directory, 'x.npy'), mmap_mode='r')
+    data_ys = [np.load(os.path.join(directory, 'y%d.npy' % head), mmap_mode='r') for head in range(numOutputs)]
+    xBuffers = np.load(os.path.join(directory, 'xRing.npy'), mmap_mode='r+')
+    yBuffers = [np.load(os.path.join(directory, 'yRing%d.npy' % head), mmap_mode='r+') for head in range(numOutputs)]
+    while True:
+        try:
+            task = cPickle.load(tasks)
+        except EOFError:
+            # The trainer went away without closing the pipeline
+            break
+        if task is None:
+            break
+        slot, step, batchIndex = task
+        # Seeded by the step, so the augmentation does not depend on which worker prepares a mini-batch
+        rng = np.random.RandomState((seed + step) % 4294967296)
+        batch = slice(batchIndex*batchSize, (batchIndex+1)*batchSize)
+        images = np.array(data_x[batch]).reshape((batchSize,) + imageShape)
+        xBuffers[slot] = augmentation.apply(images, rng).reshape((batchSize, -1))
+        for yBuffer, data_y in zip(yBuffers, data_ys):
+            yBuffer[slot] = data_y[batch]
+        cPickle.dump(slot, ready, protocol=cPickle.HIGHEST_PROTOCOL)
+        ready.flush()
+
+
+class AugmentationPipeline(object):
+    '''
+    Hands out augmented training mini-batches in order (mini-batch 0, 1, ... of every epoch). A ring of ringSize
+    shared memory slots is kept filled by the worker processes
+    '''
+    def __init__(self, data_x, data_ys, shape, batchSize, augmentation, workers=2, ringSize=4, seed=1234):
+        '''
+        :param data_x: training inputs, one flattened image per row (NumPy array, may be memory-mapped)
+        :param data_ys: list of training labels, one array per output layer
+        :param shape: shape of the InputLayer, (channels, height, width) or (height, width)
+        :param batchSize: mini-batch size
+        :param augmentation: Augmentation
+        :param workers: number of worker processes
+        :param ringSize: number of mini-batches prepared ahead, at least workers
+        '''
+        imageShape = tuple(shape)
+        if len(imageShape) == 2:
+            imageShape = (1,) + imageShape
+        if len(imageShape) != 3 and augmentation.spatial():
+            raise(AugmentationNotPossible(shape))
+
+        self.batchSize = batchSize
+        self.numBatches = data_x.shape[0] // batchSize
+        self.ringSize = max(ringSize, workers)
+        numInputs = data_x.shape[1]
+
+        self.directory = tempfile.mkdtemp(prefix='augmentation')
+        np.save(os.path.join(self.directory, 'x.npy'), data_x)
+        for head, data_y in enumerate(data_ys):
+            np.save(os.path.join(self.directory, 'y%d.npy' % head), data_y)
+        self.xBuffers = open_memmap(os.path.join(self.directory, 'xRing.npy'), mode='w+', dtype=data_x.dtype,
+                                    shape=(self.ringSize, batchSize, numInputs))
+        self.yBuffers = [open_memmap(os.path.join(self.directory, 'yRing%d.npy' % head), mode='w+',
+                                     dtype=data_y.dtype, shape=(self.ringSize, batchSize))
+                         for head, data_y in enumerate(data_ys)]
+
+        environment = dict(os.environ)
+        # The package has to be importable from the workers, whatever their working directory
+        packageParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment['PYTHONPATH'] = os.pathsep.join([packageParent] + [path for path in
+                                                                       [environment.get('PYTHONPATH')] if path])
+        self.workers = []
+        for worker in range(workers):
+            process = subprocess.Popen([sys.executable, '-m', 'deepLearningLibrary.augmentation'],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+            cPickle.dump((self.directory, imageShape, batchSize, len(data_ys), augmentation, seed), process.stdin,
+                         protocol=cPickle.HIGHEST_PROTOCOL)
+            self.workers.append(process)
+
+        # Finished slots are read by one thread per worker
+        self.ready = Queue.Queue()
+        self.readers = [threading.Thread(target=self.readSlots, args=(process,)) for process in self.workers]
+        for reader in self.readers:
+            reader.daemon = True
+            reader.start()
+
+        self.readySlots = set()
+        self.submitted = 0
+        self.consumed = 0
+        for slot in range(self.ringSize):
+            self.submit(slot)
+
+    def readSlots(self, process):
+        while True:
+            try:
+                self.ready.put(cPickle.load(process.stdout))
+            except EOFError:
+                break
+
+    def submit(self, slot):
+        # Round robin, mini-batches take about the same time to augment
+        process = self.workers[self.submitted % len(self.workers)]
+        cPickle.dump((slot, self.submitted, self.submitted % self.numBatches), process.stdin,
+                     protocol=cPickle.HIGHEST_PROTOCOL)
+        process.stdin.flush()
+        self.submitted += 1
+
+    def next(self):
+        '''
+        :return: (x, list of labels) of the next mini-batch, views into the ring that stay valid until release
+        '''
+        slot = self.consumed % self.ringSize
+        while slot not in self.readySlots:
+            try:
+                self.readySlots.add(self.ready.get(True, 1.0))
+            except Queue.Empty:
+                if any([process.poll() is not None for process in self.workers]) and self.ready.empty():
+                    raise(AugmentationWorkerFailed("An augmentation worker exited"))
+        return self.xBuffers[slot], [yBuffer[slot] for yBuffer in self.yBuffers]
+
+    def release(self):
+        '''
+        Give the slot of the last mini-batch back to the workers, once the training step has used it
+        '''
+        slot = self.consumed % self.ringSize
+        self.readySlots.remove(slot)
+        self.consumed += 1
+        self.submit(slot)
+
+    def close(self):
+        # Also called when training failed, a worker may have exited already
+        for process in self.workers:
+            if process.poll() is None:
+                try:
+                    cPickle.dump(None, process.stdin, protocol=cPickle.HIGHEST_PROTOCOL)
+                    process.stdin.flush()
+                except IOError:
+                    pass
+            process.stdin.close()
+        for process in self.workers:
+            process.wait()
+        for reader in self.readers:
+            reader.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    # An interrupt (Ctrl-C) reaches the whole process group, the trainer closes the workers in that case
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Finished slots go to the original stdout, anything printed while augmenting goes to stderr
+    ready = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    augmentationWorker(os.fdopen(0, 'rb'), ready)
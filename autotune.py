@@ -0,0 +1,179 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import cPickle
+import numpy as np
+
+'''
+Throughput autotuner. Short timed training bursts of a network run over a grid of mini-batch sizes and BLAS thread
+counts on synthetic data, each burst in a fresh interpreter since the thread count of OpenBLAS/MKL/OpenMP is read
+from the environment when Theano is first imported. The best configuration is written to a JSON file and can be
+applied by later runs before Theano is imported:
+
+    batchSize = autotune.applyBestConfiguration('autotune.json')
+    net.compile(batchSize)
+
+From the command line, with a function building the (uncompiled) network:
+
+    python -m deepLearningLibrary.autotune myModels:buildNetwork --batch-sizes 16,32,64 --threads 1,2,4
+'''
+
+threadVariables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def threadEnvironment(threads):
+    return dict((variable, str(threads)) for variable in threadVariables)
+
+
+def burst(network, batchSize, steps=20, warmup=3):
+    '''
+    Compile the network for batchSize and time plain SGD steps on one synthetic mini-batch
+    :return: dictionary with secondsPerStep and samplesPerSecond
+    '''
+    from deepLearningLibrary.backend import theano, T
+
+    network.compile(batchSize)
+
+    rng = np.random.RandomState(1234)
+    numInputs = network.inputLayer.numOfNeurons
+    x = theano.shared(np.asarray(rng.rand(batchSize, numInputs), dtype=theano.config.floatX), borrow=True)
+    ys = [T.ivector("y") for layer in network.outputLayers]
+    labels = [theano.shared(np.asarray(rng.randint(0, layer.numOfNeurons, size=batchSize), dtype='int32'))
+              for layer in network.outputLayers]
+
+    cost = sum([layer.lossWeight*layer.cost(y, batchSize) for layer, y in zip(network.outputLayers, ys)])
+    params = network.trainableParams()
+    grads = T.grad(cost, params)
+    updates = [(param, param-0.001*grad) for param, grad in zip(params, grads)]
+    updates += [update for layer in network.layers if layer.trainable for update in layer.updates]
+
+    givens = dict(zip(ys, labels))
+    givens[network.x] = x
+    train = theano.function([], cost, updates=updates, givens=givens, on_unused_input='ignore')
+
+    for step in range(warmup):
+        train()
+    tic = time.time()
+    for step in range(steps):
+        train()
+    seconds = (time.time() - tic) / steps
+    return {'secondsPerStep': seconds, 'samplesPerSecond': batchSize / seconds}
+
+
+def runBurst(networkFile, batchSize, threads, steps, warmup):
+    '''
+    Run one burst in a fresh interpreter with the thread count set in its environment
+    :return: burst result, or None if the burst failed (e.g. out of memory)
+    '''
+    environment = dict(os.environ)
+    environment.update(threadEnvironment(threads))
+    # The package has to be importable from the child, whatever its working directory
+    packageParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = os.pathsep.join([packageParent] + [path for path in
+                                                                   [environment.get('PYTHONPATH')] if path])
+    command = [sys.executable, '-m', 'deepLearningLibrary.autotune', '--burst', networkFile,
+               str(batchSize), str(steps), str(warmup)]
+    try:
+        output = subprocess.check_output(command, env=environment)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def autotune(network, batchSizes=(16, 32, 64, 128), threadCounts=(1, 2, 4), steps=20, warmup=3,
+             resultFile='autotune.json'):
+    '''
+    Time training bursts of network for every combination of batch size and thread count
+    :param network: Network with all layers and connections, not compiled
+    :param batchSizes: Mini-batch sizes to try
+    :param threadCounts: BLAS/OpenMP thread counts to try
+    :param steps: Timed training steps per burst
+    :param warmup: Untimed steps before timing
+    :param resultFile: JSON file the results and the best configuration are written to, None to not write them
+    :return: the results, with the best configuration under 'best'
+    '''
+    handle, networkFile = tempfile.mkstemp(suffix='.pickle')
+    with os.fdopen(handle, 'wb') as networkHandle:
+        cPickle.dump(network, networkHandle, protocol=cPickle.HIGHEST_PROTOCOL)
+
+    results = []
+    try:
+        for threads in threadCounts:
+            for batchSize in batchSizes:
+                result = runBurst(networkFile, batchSize, threads, steps, warmup)
+                if result is None:
+                    print('batch size {0}, {1} threads: failed'.format(batchSize, threads))
+                    continue
+                result.update({'batchSize': batchSize, 'threads': threads})
+                results.append(result)
+                print('batch size {0}, {1} threads: {2:.1f} samples/s'.format(
+                    batchSize, threads, result['samplesPerSecond']))
+    finally:
+        os.remove(networkFile)
+
+    best = None
+    if results:
+        best = max(results, key=lambda result: result['samplesPerSecond'])
+        print('Best: batch size {0} with {1} threads, {2:.1f} samples/s'.format(
+            best['batchSize'], best['threads'], best['samplesPerSecond']))
+
+    tuning = {'network': network.name, 'results': results, 'best': best}
+    if resultFile is not None:
+        with open(resultFile, 'w') as handle:
+            json.dump(tuning, handle, indent=2)
+    return tuning
+
+
+def loadBestConfiguration(resultFile='autotune.json'):
+    '''
+    :return: best configuration of an earlier autotune run, a dictionary with batchSize and threads
+    '''
+    with open(resultFile) as handle:
+        return json.load(handle)['best']
+
+
+def applyBestConfiguration(resultFile='autotune.json'):
+    '''
+    Set the thread count of the best configuration in the environment. Has to be called before Theano is imported,
+    i.e. before the first compile
+    :return: the best mini-batch size, to be passed to compile
+    '''
+    best = loadBestConfiguration(resultFile)
+    if 'theano' in sys.modules:
+        print('Theano is already imported, the thread count of {0} may not be used'.format(resultFile))
+    os.environ.update(threadEnvironment(best['threads']))
+    return best['batchSize']
+
+
+def main(arguments):
+    if arguments[0] == '--burst':
+        networkFile, batchSize, steps, warmup = arguments[1:5]
+        with open(networkFile, 'rb') as handle:
+            network = cPickle.load(handle)
+        result = burst(network, int(batchSize), int(steps), int(warmup))
+        # Compilation may print, the result is the last line
+        print(json.dumps(result))
+        return
+
+    import argparse
+    import importlib
+    parser = argparse.ArgumentParser(description='Autotune mini-batch size and BLAS thread count of a network')
+    parser.add_argument('builder', help='module:function returning the network, not compiled')
+    parser.add_argument('--batch-sizes', default='16,32,64,128')
+    parser.add_argument('--threads', default='1,2,4')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default='autotune.json')
+    options = parser.parse_args(arguments)
+
+    moduleName, functionName = options.builder.split(':')
+    network = getattr(importlib.import_module(moduleName), functionName)()
+    autotune(network, [int(size) for size in options.batch_sizes.split(',')],
+             [int(threads) for threads in options.threads.split(',')],
+             options.steps, options.warmup, options.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
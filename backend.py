@@ -0,0 +1,34 @@
+import importlib
+
+'''
+Theano and its submodules are imported the first time one of their attributes is used, not when the library is
+imported. Building or inspecting a topology, or running an exported model, then never pays for importing Theano;
+compile() is the first place that needs it.
+'''
+
+class LazyModule(object):
+
+    def __init__(self, name):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def load(self):
+        if self.__dict__['module'] is None:
+            self.__dict__['module'] = importlib.import_module(self.__dict__['name'])
+        return self.__dict__['module']
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.load(), attribute, value)
+
+
+theano = LazyModule('theano')
+T = LazyModule('theano.tensor')
+conv = LazyModule('theano.tensor.nnet.conv')
+downsample = LazyModule('theano.tensor.signal.downsample')
+rng_mrg = LazyModule('theano.sandbox.rng_mrg')
+shared_randomstreams = LazyModule('theano.tensor.shared_randomstreams')
+extra_ops = LazyModule('theano.tensor.extra_ops')
+theanoSparse = LazyModule('theano.sparse')
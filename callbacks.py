@@ -0,0 +1,76 @@
+import numpy as np
+
+'''
+Callbacks for Network.fit. A callback declares the symbolic values it wants from the training step (fetches) and
+every how many steps it wants them (frequency). The compiled training step only returns the cost, unless a callback
+with fetches is due at that step.
+'''
+
+class Callback(object):
+    '''
+    Base class, every hook does nothing by default
+    '''
+    def __init__(self, frequency=1):
+        '''
+        :param frequency: onStep is called (and the fetches are computed) every frequency training steps
+        '''
+        self.frequency = frequency
+
+    def fetches(self, network):
+        '''
+        :param network: the network being trained. network.ys (labels per output layer), network.loss and
+                        network.cost are defined at this point
+        :return: list of symbolic expressions of the training graph, evaluated by the steps onStep is called for
+        '''
+        return []
+
+    def due(self, iteration):
+        return (iteration + 1) % self.frequency == 0
+
+    def onStep(self, network, iteration, cost, values):
+        '''
+        :param values: values of the fetches, in the same order
+        '''
+        pass
+
+    def onEpochEnd(self, network, epoch):
+        pass
+
+    def onValidation(self, network, result):
+        '''
+        :param result: dictionary with epoch, iteration, headAccuracies and (for a new best) testAccuracy
+        '''
+        pass
+
+
+class TrainingMetrics(Callback):
+    '''
+    Epoch level training accuracy and loss, from the correct predictions and losses of every training step. Kept
+    in network.trainingHistory
+    '''
+    def __init__(self):
+        super(TrainingMetrics,self).__init__(frequency=1)
+
+    def fetches(self, network):
+        self.correct = np.zeros(len(network.outputLayers))
+        self.loss = 0.0
+        self.numExamples = 0
+        # Summed, so that they add up over an epoch
+        return [layer.correctCount(y) for layer, y in zip(network.outputLayers, network.ys)] + \
+               [network.loss*network.mini_batch_size]
+
+    def onStep(self, network, iteration, cost, values):
+        self.correct += np.asarray(values[:-1])
+        self.loss += values[-1]
+        self.numExamples += network.mini_batch_size
+
+    def onEpochEnd(self, network, epoch):
+        network.trainingHistory.append({'epoch': epoch,
+                                        'accuracy': np.mean(self.correct)/float(self.numExamples),
+                                        'headAccuracies': list(self.correct/float(self.numExamples)),
+                                        'loss': self.loss/self.numExamples})
+        print("Epoch {0}: training accuracy {1:.2%}, training loss {2}".format(
+            epoch, network.trainingHistory[-1]['accuracy'], network.trainingHistory[-1]['loss']))
+        self.correct = np.zeros(len(network.outputLayers))
+        self.loss = 0.0
+        self.numExamples = 0
@@ -3,23 +3,22 @@ __author__ = 'madhumathi'
 from deepLearningLibrary.layers import *
 from abc import ABCMeta, abstractmethod
 import numpy as np
-import theano
-import theano.tensor as T
-from theano.tensor.nnet import conv
-from theano.tensor.signal import downsample
+from deepLearningLibrary.backend import theano, T, conv, downsample, theanoSparse
 from layers import *
 import random
 from exceptions import *
+from deepLearningLibrary.initializations import *
 
 class Connection(object):
     '''
     Abstract class for connections between layers. Not to be instantiated
     '''
-    def __init__(self, fromLayer, toLayer, targetNeurons=None,regularization=None, initialization=None):
+    def __init__(self, fromLayer, toLayer, targetNeurons=None,regularization=None, initialization=None, trainable=True):
 
         '''
         :param fromLayer: Input connection layer
         :param toLayer: Outgoing layer
+        :param trainable: False keeps the weights fixed while training (no gradient is computed for them)
         :return:
         '''
         if targetNeurons is None:
@@ -28,10 +27,31 @@ class Connection(object):
         self.toLayer = toLayer
         self.regularization = regularization
         self.initialization = initialization
+        self.trainable = trainable
         self.output = None
         self.params = []
         self.targetNeurons = targetNeurons
 
+    def getInitialization(self,initialization):
+
+        # initialization is a string input
+        initializationFunction = None
+        if initialization == "glorotNormal":
+            initializationFunction = glorotNormal
+        elif initialization == "glorotUniform":
+            initializationFunction = glorotUniform
+        elif initialization == "heNormal":
+            initializationFunction = heNormal
+        elif initialization == "heUniform":
+            initializationFunction = heUniform
+        elif initialization == "orthogonal":
+            initializationFunction = orthogonal
+        elif initialization == "lsuv":
+            initializationFunction = lsuv
+        else:
+            raise(InitializationNotImplemented(initialization))
+        return initializationFunction
+
     #### Implement the below methods ####
 
     # def __new__(cls, *args):
@@ -48,10 +68,10 @@ class Connection(object):
 
 class OneToOneConnection(Connection):
 
-    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None, targetNeurons=None):
+    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None, targetNeurons=None, trainable=True):
 
         super(OneToOneConnection, self).__init__(fromLayer,toLayer,
-                                                 targetNeurons,regularization,initialization)
+                                                 targetNeurons,regularization,initialization,trainable)
 
     def __str__(self):
         return str(self.__dict__)
@@ -76,11 +96,15 @@ class OneToOneConnection(Connection):
         self.output = self.fromLayer.output * self.w
 
 class DenseConnection(Connection):
-    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None, targetNeurons=None):
+    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None, targetNeurons=None, trainable=True):
 
 
         super(DenseConnection, self).__init__(fromLayer,toLayer,
-                                              targetNeurons,regularization,initialization)
+                                              targetNeurons,regularization,initialization,trainable)
+        # Set by magnitude pruning (see pruning.py): zero entries of the mask are pruned weights, sparseWeights
+        # is a sparse copy of the pruned weights used in place of w for inference
+        self.mask = None
+        self.sparseWeights = None
 
     def __str__(self):
         return str(self.__dict__)
@@ -88,16 +112,17 @@ class DenseConnection(Connection):
     def initializeWeights(self):
 
         # Initialize the weight matrix according to the input and output dimensions(fromLayer and toLayer)
-        self.w = theano.shared(
-            np.asarray(
-                np.random.normal(loc=0.0, scale=np.sqrt(1.0/self.toLayer.numOfNeurons),
-                                 size=(self.fromLayer.numOfNeurons,self.targetNeurons)),
-                dtype=theano.config.floatX),
-            name='w', borrow=True)
-        self.b = theano.shared(
-            np.asarray(np.random.normal(loc=0.0, scale=1.0, size=(1,self.targetNeurons)),
-                       dtype=theano.config.floatX),
-            name='b', borrow=True,broadcastable=(True,False))
+        shape = (self.fromLayer.numOfNeurons,self.targetNeurons)
+        if self.initialization is None:
+            w = np.random.normal(loc=0.0, scale=np.sqrt(1.0/self.toLayer.numOfNeurons), size=shape)
+            b = np.random.normal(loc=0.0, scale=1.0, size=(1,self.targetNeurons))
+        else:
+            w = self.getInitialization(self.initialization)(shape)
+            b = np.zeros((1,self.targetNeurons))
+
+        self.w = theano.shared(np.asarray(w, dtype=theano.config.floatX), name='w', borrow=True)
+        self.b = theano.shared(np.asarray(b, dtype=theano.config.floatX),
+                               name='b', borrow=True,broadcastable=(True,False))
 
         self.params = [self.w, self.b]
 
@@ -110,12 +135,18 @@ class DenseConnection(Connection):
         #Also, should we also throw other such suggestions to the user such as
         # copyOfLayerOutput = self.fromLayer.output
 
-        self.output = T.dot(self.fromLayer.output,self.w) + self.b
+        if self.sparseWeights is not None:
+            self.output = theanoSparse.dot(self.fromLayer.output,self.sparseWeights) + self.b
+        else:
+            self.output = T.dot(self.fromLayer.output,self.w) + self.b
 
 class ConvolutedConnection(Connection):
-    def __init__(self, fromLayer, toLayer, regularization, initialization, input_shape, filter_shape, stride_length, zero_padding):
+    def __init__(self, fromLayer, toLayer, regularization, initialization, input_shape, filter_shape, stride_length, zero_padding,
+                 trainable=True):
 
-        super(ConvolutedConnection, self).__init__(fromLayer,toLayer,regularization,initialization)
+        super(ConvolutedConnection, self).__init__(fromLayer,toLayer,
+                                                   regularization=regularization,initialization=initialization,
+                                                   trainable=trainable)
 
         '''
         filter shape - 0 - number of filters, 1 - depth, 2 - height, 3 - width
@@ -132,12 +163,15 @@ class ConvolutedConnection(Connection):
 
     def initializeWeights(self):
 
-        self.w = theano.shared(
-            np.asarray(
-                np.random.normal(loc=0.0, size=self.filter_shape),
-                dtype=theano.config.floatX),name='w', borrow=True)
-        self.b = theano.shared(np.asarray(np.random.normal(loc=0.0, scale=1.0, size=(self.filter_shape[0],)),
-                       dtype=theano.config.floatX), name='b', borrow=True)
+        if self.initialization is None:
+            w = np.random.normal(loc=0.0, size=self.filter_shape)
+            b = np.random.normal(loc=0.0, scale=1.0, size=(self.filter_shape[0],))
+        else:
+            w = self.getInitialization(self.initialization)(tuple(self.filter_shape))
+            b = np.zeros((self.filter_shape[0],))
+
+        self.w = theano.shared(np.asarray(w, dtype=theano.config.floatX), name='w', borrow=True)
+        self.b = theano.shared(np.asarray(b, dtype=theano.config.floatX), name='b', borrow=True)
 
         self.params = [self.w,self.b]
 
@@ -156,43 +190,40 @@ class ConvolutedConnection(Connection):
         '''insert minibatchsize value also in the input_shape variable, since that will be the complete shape
         of incoming data'''
 
-        inp = list(self.input_shape)
-        inp.insert(0,miniBatchSize)
-        self.input_shape = list(inp)
+        # Kept local so that the graph can be built more than once
+        image_shape = list(self.input_shape)
+        image_shape.insert(0,miniBatchSize)
 
         ### Add zero Pads if any
         if self.zero_padding != 0:
-            if len(self.input_shape) == 4:
-                zero_padding = T.zeros((self.input_shape[0],self.input_shape[1],
-                                        self.input_shape[2] + 2*self.zero_padding,
-                                        self.input_shape[3] + 2*self.zero_padding),dtype=theano.config.floatX)
+            if len(image_shape) == 4:
+                zero_padding = T.zeros((image_shape[0],image_shape[1],
+                                        image_shape[2] + 2*self.zero_padding,
+                                        image_shape[3] + 2*self.zero_padding),dtype=theano.config.floatX)
                 zero_padding = T.set_subtensor(zero_padding[:,:,
-                                               self.zero_padding:self.input_shape[2]+self.zero_padding,
-                                               self.zero_padding:self.input_shape[3]+self.zero_padding],
+                                               self.zero_padding:image_shape[2]+self.zero_padding,
+                                               self.zero_padding:image_shape[3]+self.zero_padding],
                                                self.input)
                 self.input = zero_padding
-                input_shape = list(self.input_shape)
-                input_shape[2] = input_shape[2] + 2* self.zero_padding
-                input_shape[3] = input_shape[3] + 2* self.zero_padding
-                self.input_shape = tuple(input_shape)
-            elif len(self.input_shape) == 3:
-                zero_padding = T.zeros((self.input_shape[0],self.input_shape[1],
-                                        self.input_shape[2] + 2*self.zero_padding),dtype=theano.config.floatX)
+                image_shape[2] = image_shape[2] + 2* self.zero_padding
+                image_shape[3] = image_shape[3] + 2* self.zero_padding
+            elif len(image_shape) == 3:
+                zero_padding = T.zeros((image_shape[0],image_shape[1],
+                                        image_shape[2] + 2*self.zero_padding),dtype=theano.config.floatX)
                 zero_padding = T.set_subtensor(zero_padding[:,:,
-                                               self.zero_padding:self.input_shape[2]+self.zero_padding],
+                                               self.zero_padding:image_shape[2]+self.zero_padding],
                                                self.input)
                 self.input = zero_padding
-                input_shape = list(self.input_shape)
-                input_shape[2] = input_shape[2] + 2* self.zero_padding
-                self.input_shape = tuple(input_shape)
+                image_shape[2] = image_shape[2] + 2* self.zero_padding
+        image_shape = tuple(image_shape)
         conv_out = conv.conv2d(
             input=self.input, filters=self.w, filter_shape=self.filter_shape,
-            image_shape=self.input_shape
+            image_shape=image_shape
             ,border_mode="valid",subsample=self.stride_length
         )
 
         self.output = None
-        if len(self.input_shape) == 4:
+        if len(image_shape) == 4:
             self.output = conv_out + self.b.dimshuffle('x', 0, 'x', 'x')
         else:
             self.output = conv_out + self.b.dimshuffle('x', 0, 'x')
@@ -220,9 +251,9 @@ class MaxPoolingConnection(Connection):
         self.output = self.output.reshape(self.toLayer.shape_minibatch_flattened)
 
 class RecurrentConnection(Connection):
-    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None):
+    def __init__(self, fromLayer, toLayer, regularization=None, initialization=None, trainable=True):
 
-        super(RecurrentConnection, self).__init__(fromLayer,toLayer,None,regularization,initialization)
+        super(RecurrentConnection, self).__init__(fromLayer,toLayer,None,regularization,initialization,trainable)
 
         self.targetNeurons = self.toLayer.numOfNeurons
 
@@ -232,16 +263,17 @@ class RecurrentConnection(Connection):
     def initializeWeights(self):
 
         # Initialize the weight matrix according to the input and output dimensions(fromLayer and toLayer)
-        self.w = theano.shared(
-            np.asarray(
-                np.random.normal(loc=0.0, scale=np.sqrt(1.0/self.toLayer.numOfNeurons),
-                                 size=(self.fromLayer.numOfNeurons,self.targetNeurons)),
-                dtype=theano.config.floatX),
-            name='w', borrow=True)
-        self.b = theano.shared(
-            np.asarray(np.random.normal(loc=0.0, scale=1.0, size=(1,self.targetNeurons)),
-                       dtype=theano.config.floatX),
-            name='b', borrow=True,broadcastable=(True,False))
+        shape = (self.fromLayer.numOfNeurons,self.targetNeurons)
+        if self.initialization is None:
+            w = np.random.normal(loc=0.0, scale=np.sqrt(1.0/self.toLayer.numOfNeurons), size=shape)
+            b = np.random.normal(loc=0.0, scale=1.0, size=(1,self.targetNeurons))
+        else:
+            w = self.getInitialization(self.initialization)(shape)
+            b = np.zeros((1,self.targetNeurons))
+
+        self.w = theano.shared(np.asarray(w, dtype=theano.config.floatX), name='w', borrow=True)
+        self.b = theano.shared(np.asarray(b, dtype=theano.config.floatX),
+                               name='b', borrow=True,broadcastable=(True,False))
 
         self.recurrentHiddenState = self.fromLayer.output
         self.params = [self.w, self.b]
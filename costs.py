@@ -1,5 +1,4 @@
-import theano
-import theano.tensor as T
+from deepLearningLibrary.backend import theano, T
 import numpy as np
 
 eps = 1e-9
@@ -23,6 +22,11 @@ def crossEntropy(output,y):
 def negativeLogLikelihood(output,y):
     return -T.mean(T.log(output + eps)[T.arange(y.shape[0]), y])
 
+def softmaxNegativeLogLikelihood(z,y):
+    # z are the activations before the softmax. Theano compiles this to a single softmax/cross-entropy op
+    # instead of softmax, clip, log and indexing as separate passes
+    return T.mean(T.nnet.crossentropy_softmax_1hot(z, y)[0])
+
 def kullbackLeiblerDivergence(output, y):
     return T.mean((y * (T.log(y + eps)-T.log(output + eps)))[T.arange(y.shape[0]), y])
 
@@ -32,6 +36,38 @@ def poisson(output,y):
 def cosine_proximity(output,y):
     return -T.mean((output * y)[T.arange(y.shape[0]), y])
 
+def sampledLogits(h,wRows,bRows,y,sampled,yRows,sampledRows,logProposal):
+    '''
+    Logits of a softmax restricted to the true class and a set of sampled classes
+    :param h: Input to the output connection (minibatch x fromNeurons)
+    :param wRows: Gathered columns of the output connection weights, one row per touched class (touched x fromNeurons)
+    :param bRows: Gathered bias of the touched classes
+    :param y: True class of each example
+    :param sampled: Classes sampled from the proposal distribution
+    :param yRows: Row of wRows and bRows holding each true class
+    :param sampledRows: Row of wRows and bRows holding each sampled class
+    :param logProposal: Log probability of every class under the proposal distribution
+    :return: symbolic logits (minibatch x 1+samples), the true class first
+    '''
+    # Subtract the log expected count of each class so that the sampled softmax is an unbiased estimate
+    logExpected = T.log(T.cast(sampled.shape[0], theano.config.floatX)) + logProposal
+    trueLogits = T.sum(h * wRows[yRows], axis=1) + bRows[yRows] - logExpected[y]
+    sampledLogits = T.dot(h, wRows[sampledRows].T) + bRows[sampledRows] - logExpected[sampled]
+
+    # A sampled class that is also the true class must not count as a negative
+    sampledLogits = T.switch(T.eq(y.dimshuffle(0, 'x'), sampled.dimshuffle('x', 0)), -1e9, sampledLogits)
+
+    return T.concatenate([trueLogits.dimshuffle(0, 'x'), sampledLogits], axis=1)
+
+def sampledNegativeLogLikelihood(logits):
+    '''
+    :param logits: logits of the true class (first column) and the sampled classes, see sampledLogits
+    :return: symbolic mean loss over the minibatch
+    '''
+    maxLogits = T.max(logits, axis=1)
+    logNormalizer = maxLogits + T.log(T.sum(T.exp(logits - maxLogits.dimshuffle(0, 'x')), axis=1))
+    return T.mean(logNormalizer - logits[:, 0])
+
 
 
 def tester():
@@ -0,0 +1,199 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import cPickle
+import numpy as np
+from deepLearningLibrary.backend import theano
+from deepLearningLibrary.exceptions import *
+
+'''
+Preprocessed dataset cache. A pickled (training, validation, test) dataset, such as mnist.pkl.gz, is converted once
+into .npy arrays of the right dtypes, in a directory named by a fingerprint of the source file, the preprocessing
+and the dtypes. Later runs memory-map the arrays instead of decompressing and unpickling the source again, and the
+shared variables are created straight from them.
+
+Compact datasets keep the inputs as uint8 and the labels in the smallest integer dtype that holds them. Scaling and
+the preprocessing then happen on the graph, per minibatch, through the scale and mean of the InputLayer.
+'''
+
+cacheVersion = 1
+splits = ['training', 'validation', 'test']
+
+def getPreprocessing(preprocessing):
+
+    # preprocessing is a string input
+    if preprocessing is None:
+        return None
+    elif preprocessing == "center":
+        return lambda x, mean, std: x - mean
+    elif preprocessing == "standardize":
+        return lambda x, mean, std: (x - mean) / std
+    else:
+        raise(PreprocessingNotImplemented(preprocessing))
+
+
+def fingerprint(source, preprocessing=None, dtype=None, labelDtype='int32', compact=False):
+    '''
+    :return: key of the converted dataset. The source file is identified by its path, size and modification time
+    '''
+    status = os.stat(source)
+    key = json.dumps([cacheVersion, os.path.abspath(source), status.st_size, status.st_mtime,
+                      preprocessing, np.dtype(dtype).name, np.dtype(labelDtype).name, compact])
+    return hashlib.sha1(key).hexdigest()
+
+
+def readPickledDataset(source):
+    opener = gzip.open if source.endswith('.gz') else open
+    with opener(source, 'rb') as handle:
+        return cPickle.load(handle)
+
+
+def compactLabelDtype(data):
+    # Smallest integer dtype holding every label of the three splits
+    labels = [np.asarray(y) for x, y in data]
+    return np.promote_types(np.min_scalar_type(int(max([y.max() for y in labels]))),
+                            np.min_scalar_type(int(min([y.min() for y in labels]))))
+
+
+def convertCompactDataset(data, directory, preprocessing):
+    '''
+    Inputs are quantized to uint8 over the value range of the training inputs, x ~ low + q*step. The scale and mean
+    undoing the quantization and applying the preprocessing on the graph are saved in normalization.npz
+    '''
+    training_x = np.asarray(data[0][0], dtype='float64')
+    low = min(training_x.min(), 0.0)
+    step = (training_x.max() - low) / 255.0
+    if step == 0:
+        step = 1.0
+
+    # normalized = (low + q*step - mean) / std = q*scale - graphMean
+    getPreprocessing(preprocessing)
+    mean, std = 0.0, 1.0
+    if preprocessing is not None:
+        mean = np.mean(training_x, axis=0)
+        if preprocessing == "standardize":
+            std = np.std(training_x, axis=0) + 1e-8
+    scale = np.asarray(step / std, dtype='float64')
+    graphMean = np.asarray((mean - low) / std, dtype='float64')
+    fileName = os.path.join(directory, 'normalization.npz')
+    handle, temporaryName = temporaryFile(fileName)
+    with handle:
+        np.savez(handle, scale=scale, mean=graphMean)
+    os.rename(temporaryName, fileName)
+
+    labelDtype = compactLabelDtype(data)
+    for split, (x, y) in zip(splits, data):
+        q = np.clip(np.rint((np.asarray(x, dtype='float64') - low) / step), 0, 255).astype('uint8')
+        saveArray(directory, split, 'x', q)
+        saveArray(directory, split, 'y', np.asarray(y, dtype=labelDtype))
+
+
+def temporaryFile(fileName, mode='wb'):
+    '''
+    :return: (open file, name) of a new file next to fileName. Processes converting the same dataset at the same
+             time each write their own file, and the last rename wins
+    '''
+    handle, temporaryName = tempfile.mkstemp(dir=os.path.dirname(fileName), prefix=os.path.basename(fileName),
+                                             suffix='.tmp')
+    return os.fdopen(handle, mode), temporaryName
+
+
+def saveArray(directory, split, name, array):
+    fileName = os.path.join(directory, '%s_%s.npy' % (split, name))
+    handle, temporaryName = temporaryFile(fileName)
+    with handle:
+        np.save(handle, np.ascontiguousarray(array))
+    os.rename(temporaryName, fileName)
+
+
+def convertDataset(source, cacheDir=None, preprocessing=None, dtype=None, labelDtype='int32', compact=False):
+    '''
+    Write the cached arrays of source, unless they exist already
+    :param source: pickle (optionally gzipped) of the (x, y) pairs of the training, validation and test data
+    :param cacheDir: directory for the converted datasets, by default next to the source
+    :param preprocessing: None, 'center' or 'standardize' with the training set statistics
+    :param dtype: dtype of the inputs, theano.config.floatX by default
+    :param labelDtype: dtype of the labels
+    :param compact: keep uint8 inputs and small integer labels, with the normalization done on the graph
+    :return: directory holding the arrays
+    '''
+    if dtype is None:
+        dtype = theano.config.floatX
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(os.path.abspath(source)), 'cache')
+    directory = os.path.join(cacheDir, fingerprint(source, preprocessing, dtype, labelDtype, compact))
+    manifestFile = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifestFile):
+        return directory
+
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Created by a process converting the same dataset
+        if not os.path.isdir(directory):
+            raise
+    data = readPickledDataset(source)
+    manifest = {'source': os.path.abspath(source), 'preprocessing': preprocessing, 'compact': compact,
+                'shapes': dict((split, [list(np.shape(x)), len(y)]) for split, (x, y) in zip(splits, data))}
+    if compact:
+        convertCompactDataset(data, directory, preprocessing)
+        writeManifest(manifestFile, manifest)
+        return directory
+
+    preprocess = getPreprocessing(preprocessing)
+    if preprocess is not None:
+        # Statistics of the training inputs are used for all three splits
+        mean = np.mean(data[0][0], axis=0)
+        std = np.std(data[0][0], axis=0) + 1e-8
+
+    for split, (x, y) in zip(splits, data):
+        x = np.asarray(x, dtype=dtype)
+        if preprocess is not None:
+            x = np.asarray(preprocess(x, mean, std), dtype=dtype)
+        saveArray(directory, split, 'x', x)
+        saveArray(directory, split, 'y', np.asarray(y, dtype=labelDtype))
+
+    writeManifest(manifestFile, manifest)
+    return directory
+
+
+def writeManifest(manifestFile, manifest):
+    # The manifest is written last, an interrupted conversion is redone
+    handle, temporaryName = temporaryFile(manifestFile, 'w')
+    with handle:
+        json.dump(manifest, handle)
+    os.rename(temporaryName, manifestFile)
+
+
+def loadDataset(source, cacheDir=None, preprocessing=None, dtype=None, labelDtype='int32', mmap_mode='r',
+                compact=False):
+    '''
+    :param mmap_mode: memory-map mode of numpy.load, None reads the arrays into memory
+    :return: list of (x, y) NumPy arrays for the training, validation and test data
+    '''
+    directory = convertDataset(source, cacheDir, preprocessing, dtype, labelDtype, compact)
+    return [(np.load(os.path.join(directory, '%s_x.npy' % split), mmap_mode=mmap_mode),
+             np.load(os.path.join(directory, '%s_y.npy' % split), mmap_mode=mmap_mode)) for split in splits]
+
+
+def loadSharedDataset(source, cacheDir=None, preprocessing=None, dtype=None, labelDtype='int32'):
+    '''
+    :return: list of (x, y) shared variables for the training, validation and test data, as used by Network.fit
+    '''
+    # Copy-on-write maps give writeable arrays whose pages are only read when used
+    return [(theano.shared(x, borrow=True), theano.shared(y, borrow=True))
+            for x, y in loadDataset(source, cacheDir, preprocessing, dtype, labelDtype, mmap_mode='c')]
+
+
+def loadCompactSharedDataset(source, cacheDir=None, preprocessing=None):
+    '''
+    :return: (list of (x, y) shared variables with uint8 inputs and small integer labels, normalization). The
+             normalization dictionary holds the scale and mean for the InputLayer, InputLayer(shape, **normalization)
+    '''
+    directory = convertDataset(source, cacheDir, preprocessing, compact=True)
+    data = [(theano.shared(x, borrow=True), theano.shared(y, borrow=True))
+            for x, y in loadDataset(source, cacheDir, preprocessing, mmap_mode='c', compact=True)]
+    normalization = np.load(os.path.join(directory, 'normalization.npz'))
+    return data, {'scale': normalization['scale'], 'mean': normalization['mean']}
@@ -63,4 +63,63 @@ class PoolingNotPossible(Exception):
 
 class ConvolutionNotPossible(Exception):
     def __init__(self):
-        super(ConvolutionNotPossible,self).__init__(makeErrorMessage("Convolution between the two layers not possible. Please check the convolution configuration"))
\ No newline at end of file
+        super(ConvolutionNotPossible,self).__init__(makeErrorMessage("Convolution between the two layers not possible. Please check the convolution configuration"))
+
+class ProposalDistributionInvalid(Exception):
+    def __init__(self, numOfClasses):
+        super(ProposalDistributionInvalid,self).__init__(makeErrorMessage("Proposal distribution must be 'uniform', 'logUniform' or %d non negative class weights" % numOfClasses))
+
+
+class SampledSoftmaxNotPossible(Exception):
+    def __init__(self):
+        super(SampledSoftmaxNotPossible,self).__init__(makeErrorMessage("Sampled softmax needs exactly one incoming Dense connection on the output layer"))
+
+
+class InitializationNotImplemented(Exception):
+    def __init__(self, initialization):
+        super(InitializationNotImplemented,self).__init__(makeErrorMessage("Initialization is not implemented %s" % initialization))
+
+
+class BatchNormFoldingNotPossible(Exception):
+    def __init__(self):
+        super(BatchNormFoldingNotPossible,self).__init__(makeErrorMessage("Batch normalization can only be folded into a single incoming Dense or Convoluted connection"))
+
+
+class TargetsMismatch(Exception):
+    def __init__(self, numOfOutputs, numOfTargets):
+        super(TargetsMismatch,self).__init__(makeErrorMessage("Network has %d output layers but %d sets of labels were given" % (numOfOutputs, numOfTargets)))
+
+
+class CheckpointNotPossible(Exception):
+    def __init__(self, layerName):
+        super(CheckpointNotPossible,self).__init__(makeErrorMessage("Layer %s is recomputed between two checkpoints and can not use dropout" % layerName))
+
+
+class MemoryBudgetExceeded(Exception):
+    def __init__(self, budget, required):
+        super(MemoryBudgetExceeded,self).__init__(makeErrorMessage("Memory budget of %d bytes is too small, a mini-batch of size 1 needs about %d bytes" % (budget, required)))
+
+
+class ValidationWorkerFailed(Exception):
+    def __init__(self, reason):
+        super(ValidationWorkerFailed,self).__init__(makeErrorMessage("Asynchronous validation failed: %s" % reason))
+
+
+class PreprocessingNotImplemented(Exception):
+    def __init__(self, preprocessing):
+        super(PreprocessingNotImplemented,self).__init__(makeErrorMessage("Preprocessing is not implemented %s" % preprocessing))
+
+
+class AugmentationNotPossible(Exception):
+    def __init__(self, shape):
+        super(AugmentationNotPossible,self).__init__(makeErrorMessage("Crops, shifts and flips need an input layer shaped (channels, height, width), not %s" % (shape,)))
+
+
+class AugmentationWorkerFailed(Exception):
+    def __init__(self, reason):
+        super(AugmentationWorkerFailed,self).__init__(makeErrorMessage("Data augmentation failed: %s" % reason))
+
+
+class StepsPerCallNotPossible(Exception):
+    def __init__(self, reason):
+        super(StepsPerCallNotPossible,self).__init__(makeErrorMessage("Several training steps per call are not possible, %s" % reason))
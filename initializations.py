@@ -0,0 +1,48 @@
+import numpy as np
+
+''' Set of weight initialization schemes. Each one takes the shape of a weight tensor and returns an array '''
+
+def computeFans(shape):
+    # Dense weights are (fromNeurons, toNeurons), convolution filters are (numFilters, depth, height, width)
+    if len(shape) == 2:
+        return shape[0], shape[1]
+    receptiveField = int(np.prod(shape[2:]))
+    return shape[1] * receptiveField, shape[0] * receptiveField
+
+
+def glorotNormal(shape):
+    fanIn, fanOut = computeFans(shape)
+    return np.random.normal(loc=0.0, scale=np.sqrt(2.0 / (fanIn + fanOut)), size=shape)
+
+
+def glorotUniform(shape):
+    fanIn, fanOut = computeFans(shape)
+    limit = np.sqrt(6.0 / (fanIn + fanOut))
+    return np.random.uniform(low=-limit, high=limit, size=shape)
+
+
+def heNormal(shape):
+    # Keeps the variance of relu outputs constant from layer to layer
+    fanIn, fanOut = computeFans(shape)
+    return np.random.normal(loc=0.0, scale=np.sqrt(2.0 / fanIn), size=shape)
+
+
+def heUniform(shape):
+    fanIn, fanOut = computeFans(shape)
+    limit = np.sqrt(6.0 / fanIn)
+    return np.random.uniform(low=-limit, high=limit, size=shape)
+
+
+def orthogonal(shape, gain=1.0):
+    # Orthogonalize a gaussian matrix with one row per filter (or one row per input neuron for dense weights)
+    flatShape = (shape[0], int(np.prod(shape[1:])))
+    a = np.random.normal(loc=0.0, scale=1.0, size=flatShape)
+    u, _, v = np.linalg.svd(a, full_matrices=False)
+    q = u if u.shape == flatShape else v
+    return gain * q.reshape(shape)
+
+
+def lsuv(shape):
+    # Layer-sequential unit variance starts from orthogonal weights, Network.lsuvInitialize then rescales them
+    # on a sample batch
+    return orthogonal(shape)
@@ -0,0 +1,175 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+'''
+NumPy implementations of the feedforward pass, for running trained networks without Theano.
+Layers and connections are described by plain dictionaries (see Network.graphSpecification), the
+computations match the compiled Theano graph used for validation and test.
+'''
+
+epsilon = 10e-5
+
+def activation(name, z):
+    if name == 'sigmoid':
+        # Theano's hard_sigmoid, which is what the sigmoid layers use
+        return np.clip(0.2 * z + 0.5, 0.0, 1.0)
+    elif name == 'tanh':
+        return np.tanh(z)
+    elif name == 'relu':
+        return np.where(z < 0.0, 0.0, z).astype(z.dtype)
+    elif name == 'softmax':
+        e = np.exp(z - z.max(axis=1, keepdims=True))
+        return np.clip(e / e.sum(axis=1, keepdims=True), epsilon, 1.0 - epsilon)
+    elif name == 'passthrough':
+        return z
+    raise ValueError('Unknown activation %s' % name)
+
+
+def dense(x, w, b):
+    return np.dot(x, w) + b
+
+
+def pad2d(x, padding):
+    if padding == 0:
+        return x
+    return np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)), mode='constant')
+
+
+def im2col(x, kernelHeight, kernelWidth, stride):
+    '''
+    :param x: images (minibatch, channels, height, width)
+    :return: patches (minibatch, outHeight, outWidth, channels*kernelHeight*kernelWidth)
+    '''
+    numImages, channels, height, width = x.shape
+    outHeight = (height - kernelHeight) // stride[0] + 1
+    outWidth = (width - kernelWidth) // stride[1] + 1
+    s0, s1, s2, s3 = x.strides
+    patches = as_strided(x, shape=(numImages, outHeight, outWidth, channels, kernelHeight, kernelWidth),
+                         strides=(s0, s2 * stride[0], s3 * stride[1], s1, s2, s3))
+    return patches.reshape((numImages, outHeight, outWidth, channels * kernelHeight * kernelWidth))
+
+
+def flipFilters(w):
+    # theano.tensor.nnet.conv.conv2d is a true convolution, so the filters are flipped for a correlation
+    return w[:, :, ::-1, ::-1]
+
+
+def conv2d(x, w, b, stride, padding):
+    '''
+    :param x: images (minibatch, channels, height, width)
+    :param w: filters (numFilters, channels, height, width) as used by ConvolutedConnection
+    :param b: bias (numFilters,)
+    :return: feature maps (minibatch, numFilters, outHeight, outWidth)
+    '''
+    patches = im2col(pad2d(x, padding), w.shape[2], w.shape[3], stride)
+    out = np.dot(patches, flipFilters(w).reshape((w.shape[0], -1)).T) + b
+    return out.transpose((0, 3, 1, 2))
+
+
+def maxPool2d(x, poolSize):
+    # Non overlapping pooling, ignoring the border like downsample.max_pool_2d(ignore_border=True)
+    numImages, channels, height, width = x.shape
+    outHeight, outWidth = height // poolSize[0], width // poolSize[1]
+    x = x[:, :, :outHeight * poolSize[0], :outWidth * poolSize[1]]
+    x = x.reshape((numImages, channels, outHeight, poolSize[0], outWidth, poolSize[1]))
+    return x.max(axis=5).max(axis=3)
+
+
+def batchNorm(x, layer):
+    # Inference time batch normalization with the running statistics
+    scale = layer['gamma'] / np.sqrt(layer['runningVar'] + layer['epsilon'])
+    shift = layer['beta'] - layer['runningMean'] * scale
+    if len(layer['shape']) == 3:
+        out = x.reshape((x.shape[0],) + tuple(layer['shape'])) * scale.reshape((1, -1, 1, 1)) + \
+              shift.reshape((1, -1, 1, 1))
+        return out.reshape(x.shape)
+    return x * scale + shift
+
+
+def connectionForward(connection, x):
+    '''
+    Output of a connection (minibatch x targetNeurons) for the flattened output x of its fromLayer
+    '''
+    kind = connection['type']
+    if kind == 'dense':
+        return dense(x, connection['w'], connection['b'])
+    elif kind == 'oneToOne':
+        return x * connection['w']
+    elif kind == 'convolution':
+        images = x.reshape((x.shape[0],) + tuple(connection['fromShape']))
+        out = conv2d(images, connection['w'], connection['b'], connection['stride'], connection['padding'])
+        return out.reshape((x.shape[0], -1))
+    elif kind == 'maxPool':
+        images = x.reshape((x.shape[0],) + tuple(connection['fromShape']))
+        return maxPool2d(images, connection['poolSize']).reshape((x.shape[0], -1))
+    raise ValueError('Unknown connection type %s' % kind)
+
+
+def layerForward(layer, connections, outputs, connectionKernel=connectionForward):
+    '''
+    Aggregate the incoming connection outputs of a layer and apply its pass function
+    :param outputs: dictionary layer name -> output of the layers computed so far
+    '''
+    inputs = [connectionKernel(connections[index], outputs[connections[index]['from']])
+              for index in layer['inConnections']]
+
+    if layer['aggregate_method'] == 'sum':
+        total = inputs[0]
+        for connectionOutput in inputs[1:]:
+            total = total + connectionOutput
+    elif layer['aggregate_method'] == 'concat':
+        total = np.concatenate(inputs, axis=1)
+    else:
+        total = inputs[0]
+
+    # In the compiled graph a recurrent connection only contributes its bias, its hidden state starts at zero
+    for index in layer['recurrentInConnections']:
+        total = total + connections[index]['b']
+
+    if layer['kind'] == 'batchNorm' and not layer['folded']:
+        total = batchNorm(total, layer)
+    return activation(layer['passFunction'], total)
+
+
+def normalizeInput(x, layer):
+    # Scale and mean of the InputLayer, for datasets kept in a compact dtype
+    if layer.get('scale') is not None:
+        x = x * layer['scale']
+    if layer.get('mean') is not None:
+        x = x - layer['mean']
+    return x
+
+
+def forward(layers, connections, x, connectionKernel=connectionForward, pool=None):
+    '''
+    Run the network described by layers (in topological order) and connections on a minibatch x
+    :param pool: Optional thread pool. Layers of the same dependency level then run concurrently, NumPy releases
+                 the GIL inside the matrix products
+    :return: dictionary layer name -> output
+    '''
+    outputs = {}
+
+    def run(layer):
+        if layer['kind'] == 'input':
+            return activation(layer['passFunction'], normalizeInput(x.reshape((x.shape[0], -1)), layer))
+        return layerForward(layer, connections, outputs, connectionKernel)
+
+    for level in dependencyLevels(layers):
+        if pool is not None and len(level) > 1:
+            results = pool.map(run, level)
+        else:
+            results = [run(layer) for layer in level]
+        for layer, result in zip(level, results):
+            outputs[layer['name']] = result
+    return outputs
+
+
+def dependencyLevels(layers):
+    # Consecutive layers with the same level, a layer without a level is a level of its own
+    levels = []
+    for layer in layers:
+        if levels and layer.get('level') is not None and levels[-1][-1].get('level') == layer['level']:
+            levels[-1].append(layer)
+        else:
+            levels.append([layer])
+    return levels
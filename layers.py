@@ -6,20 +6,26 @@ from deepLearningLibrary.costs import *
 from deepLearningLibrary.connections import *
 from abc import ABCMeta, abstractmethod
 import numpy as np
-import theano
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+from deepLearningLibrary.backend import theano, T, rng_mrg, shared_randomstreams, extra_ops
 
 class Layer(object):
     '''
     Abstract class for layers. Not to be instantiated
     '''
-    def __init__(self, shape, passFunction, aggregate_method=None, dropout=None,lossFunction=None,ifOutput = False):
+    def __init__(self, shape, passFunction, aggregate_method=None, dropout=None,lossFunction=None,ifOutput = False,
+                 lossWeight=1.0, trainable=True, checkpoint=False):
         '''
         :param name: Name for the layer
         :param shape: Shape of the current Layer(num of neurons spatially arranged)
         :param inConnections: list of incoming connection objects
         :param outConnections: list of outgoing connection objects
         :param aggregate_method: function to specify method of concatenating
+        :param lossWeight: Weight of this layer's loss in the network cost, when it is one of several output layers
+        :param trainable: False freezes the layer, its own parameters and those of its incoming connections are not
+                          trained
+        :param checkpoint: Keep the output of this layer for backpropagation, the layers between two checkpoints are
+                           recomputed during the backward pass instead of keeping their outputs (see
+                           Network.checkpointReplacements)
         :return:
         '''
 
@@ -31,6 +37,9 @@ class Layer(object):
         self.recurrentOutConnections = []
         self.numOfNeurons = 1
         self.ifOutput = ifOutput
+        self.lossWeight = lossWeight
+        self.trainable = trainable
+        self.checkpoint = checkpoint
 
         for i in self.shape:
             self.numOfNeurons *= i
@@ -41,6 +50,12 @@ class Layer(object):
         self.passFunction = self.getPassFunction(passFunction)
         self.dropout = dropout
 
+        # Layers with their own parameters or state (e.g. batch normalization) fill these in run()
+        self.params = []
+        self.updates = []
+        # Training graph variable -> inference graph variable, applied by the network for inference functions
+        self.inferenceReplacements = {}
+
 
     def setName(self,name):
         self.name = name
@@ -123,16 +138,21 @@ class Layer(object):
         self.shape_with_minibatch = tuple(self.shape_with_minibatch)
 
     def addDropout(self):
+        '''
+        Inverted dropout with an independent mask for every example of the minibatch. The mask is replaced by ones
+        in the inference graph, which then has no random number generation left
+        '''
         if self.dropout is not None:
             if self.dropout < 0. or self.dropout >= 1:
                 raise(DropoutPercentInvalid(self.dropout))
-            rng = RandomStreams()
+            rng = rng_mrg.MRG_RandomStreams()
             retain_prob = 1. - self.dropout
 
-            random_tensor = rng.binomial(self.numOfNeurons, p=retain_prob, dtype=self.output.dtype)
-            random_tensor = T.patternbroadcast(random_tensor, [dim == 1 for dim in self.shape_minibatch_flattened])
-            self.output *= random_tensor
-            self.output /= retain_prob
+            mask = rng.binomial(size=self.shape_minibatch_flattened, p=retain_prob, dtype=self.output.dtype)
+            mask = mask / np.asarray(retain_prob, dtype=self.output.dtype)
+            self.output = self.output * mask
+            self.inferenceReplacements[mask] = T.patternbroadcast(
+                T.ones(self.shape_minibatch_flattened, dtype=mask.dtype), mask.broadcastable)
 
     def run(self,minibatchSize):
         '''
@@ -143,6 +163,7 @@ class Layer(object):
 
         ### compute shape Tuples(Hack :( )
         self.computeShapes(minibatchSize)
+        self.inferenceReplacements = {}
 
         self.input = T.zeros(shape=(minibatchSize,self.numOfNeurons))
 
@@ -171,7 +192,9 @@ class Layer(object):
         else:
             self.output = self.passFunction(self.input)
         '''
-        self.output = self.passFunction(self.input)
+        # Value the pass function is applied to, the fused softmax cost starts from it
+        self.preActivation = self.input
+        self.output = self.passFunction(self.preActivation)
 
         # Add dropout
         self.addDropout()
@@ -180,11 +203,31 @@ class Layer(object):
 
     def cost(self, y, size):
         "Return the log-likelihood cost."
+        if self.hasFusedSoftmaxCost():
+            return softmaxNegativeLogLikelihood(self.preActivation.reshape((size, self.numOfNeurons)),y)
+
         self.output = self.output.reshape((size, self.numOfNeurons))
         # return -T.mean(T.log(self.output)[T.arange(size), y])
         return self.lossFunction(self.output,y)
         # return -T.mean(y * T.log(self.output) + (1-y) * T.log(1 - self.output))
 
+    def hasFusedSoftmaxCost(self):
+        '''
+        A softmax layer trained with negative log likelihood can compute its cost straight from the value its pass
+        function is applied to (self.preActivation, the normalized input for batch normalization). The (clipped)
+        probabilities in self.output are then only used for inference. Other losses, crossEntropy included, keep
+        their own formula on the probabilities
+        '''
+        return self.passFunction is softmax and self.dropout is None and \
+               self.lossFunction is negativeLogLikelihood
+
+    def correctCount(self, y):
+        "Return the number of correct predictions in the mini-batch."
+        if self.hasFusedSoftmaxCost():
+            # Softmax keeps the argmax, so the training step does not need the probabilities
+            return T.sum(T.eq(y, T.argmax(self.preActivation, axis=1)))
+        return T.sum(T.eq(y, self.y_out))
+
     def accuracy(self, y):
         "Return the accuracy for the mini-batch."
         print self.y_out.shape
@@ -257,35 +300,53 @@ class Layer(object):
 
 class InputLayer(Layer):
 
-    def __init__(self, inputShape,passFunction="passthrough",aggregate_method=None, lossFunction=None, ifOutput=False):
-        super(InputLayer,self).__init__(inputShape,passFunction,aggregate_method,lossFunction)
+    def __init__(self, inputShape,passFunction="passthrough",aggregate_method=None, lossFunction=None, ifOutput=False,
+                 scale=None, mean=None):
+        '''
+        :param scale: Factor (scalar or one per input neuron) the inputs are multiplied with on the graph, e.g. for
+                      datasets kept as uint8 (see datasets.loadCompactSharedDataset)
+        :param mean: Subtracted from the scaled inputs on the graph
+        '''
+        super(InputLayer,self).__init__(inputShape,passFunction,aggregate_method,lossFunction=lossFunction,ifOutput=ifOutput)
+        self.scale = None if scale is None else np.asarray(scale, dtype=theano.config.floatX)
+        self.mean = None if mean is None else np.asarray(mean, dtype=theano.config.floatX)
 
     def firstLayerRun(self, input, minibatchSize):
         ### compute shape Tuples(Hack :( )
         self.computeShapes(minibatchSize)
         input = input.reshape(self.shape_minibatch_flattened)
+        # Normalization happens per minibatch, so the dataset can stay in its compact dtype
+        if self.scale is not None:
+            input = input * self.scale
+        if self.mean is not None:
+            input = input - self.mean
         self.output = self.passFunction(input)
 
 class ActivationLayer(Layer):
 
-    def __init__(self, inputShape, passFunction,aggregate_method=None, lossFunction=None, ifOutput=False, dropout=None):
+    def __init__(self, inputShape, passFunction,aggregate_method=None, lossFunction=None, ifOutput=False, dropout=None,
+                 lossWeight=1.0, trainable=True, checkpoint=False):
 
-        super(ActivationLayer,self).__init__(inputShape,passFunction,aggregate_method,lossFunction=lossFunction,ifOutput=ifOutput)
+        super(ActivationLayer,self).__init__(inputShape,passFunction,aggregate_method,dropout=dropout,lossFunction=lossFunction,ifOutput=ifOutput,
+                                             lossWeight=lossWeight,trainable=trainable,checkpoint=checkpoint)
 
         # self.ifOutput = ifOutput  # this is a boolean
 
 class MemoryLayer(Layer):
     # check this!!!
     def __init__(self, inputShape,passFunction,
-                 aggregate_method=None, lossFunction=None, ifOutput=False, dropout=None):
+                 aggregate_method=None, lossFunction=None, ifOutput=False, dropout=None, lossWeight=1.0, trainable=True,
+                 checkpoint=False):
 
-        super(MemoryLayer,self).__init__(inputShape,passFunction,aggregate_method,lossFunction=lossFunction,ifOutput=ifOutput)
+        super(MemoryLayer,self).__init__(inputShape,passFunction,aggregate_method,dropout=dropout,lossFunction=lossFunction,ifOutput=ifOutput,
+                                         lossWeight=lossWeight,trainable=trainable,checkpoint=checkpoint)
 
         # self.ifOutput = ifOutput  # this is a boolean
 
     def run(self,minibatchSize):
 
         self.computeShapes(minibatchSize)
+        self.inferenceReplacements = {}
         self.input = T.zeros(shape=(minibatchSize,self.numOfNeurons))
 
         # compute connection outputs (currently flattened outputs)
@@ -311,8 +372,225 @@ class MemoryLayer(Layer):
         else:
             self.output += self.passFunction(self.input)
         '''
-        self.output += self.passFunction(self.input)
+        self.preActivation = self.input
+        self.output += self.passFunction(self.preActivation)
+
+        self.addDropout()
+
+        self.y_out = T.argmax(self.output, axis=1)
+
+class SampledSoftmaxLayer(Layer):
+    '''
+    Softmax output layer for very large class counts. Training uses a softmax over the true class and numSamples
+    classes drawn from a proposal distribution, so the cost is O(numSamples) instead of O(classes). The full
+    softmax output is still defined for evaluation and predictions.
+    '''
+    def __init__(self, inputShape, numSamples, proposal='uniform', aggregate_method=None,
+                 lossFunction="negativeLogLikelihood", ifOutput=True, dropout=None, lossWeight=1.0, trainable=True):
+        '''
+        :param inputShape: Shape of the layer, one neuron per class
+        :param numSamples: Number of classes sampled for every training minibatch
+        :param proposal: 'uniform', 'logUniform' (for class ids sorted by decreasing frequency) or an array of
+                         non negative class weights, for example unigram counts
+        '''
+        super(SampledSoftmaxLayer,self).__init__(inputShape,'softmax',aggregate_method,lossFunction=lossFunction,ifOutput=ifOutput,
+                                                 lossWeight=lossWeight,trainable=trainable)
+        self.numSamples = numSamples
+        self.proposal = self.getProposalDistribution(proposal)
+
+    def getProposalDistribution(self,proposal):
+
+        if isinstance(proposal,str) and proposal == 'uniform':
+            weights = np.ones(self.numOfNeurons)
+        elif isinstance(proposal,str) and proposal == 'logUniform':
+            classes = np.arange(self.numOfNeurons)
+            weights = np.log(classes + 2.0) - np.log(classes + 1.0)
+        else:
+            weights = np.asarray(proposal, dtype='float64')
+            if isinstance(proposal,str) or weights.shape != (self.numOfNeurons,) or \
+                    np.any(weights < 0) or weights.sum() <= 0:
+                raise(ProposalDistributionInvalid(self.numOfNeurons))
+
+        return weights / weights.sum()
+
+    def cost(self, y, size):
+        "Return the sampled log-likelihood cost. Only the true and sampled columns of the weights are touched."
+        if len(self.inConnections) != 1 or len(self.recurrentInConnections) != 0 or \
+                not isinstance(self.inConnections[0],DenseConnection):
+            raise(SampledSoftmaxNotPossible())
+        connection = self.inConnections[0]
+
+        # Sampling happens on the host, the proposal is tiny compared to the weight matrix
+        rng = shared_randomstreams.RandomStreams()
+        # choice needs p as a variable (it tests p for truth), kept in float64 so that it sums to 1 for NumPy
+        proposal = theano.shared(np.asarray(self.proposal, dtype='float64'), name='proposal')
+        sampled = rng.choice(size=(self.numSamples,), a=self.numOfNeurons, p=proposal)
+        logProposal = np.asarray(np.log(self.proposal + 1e-30), dtype=theano.config.floatX)
+
+        # Columns of the touched classes are gathered once. fit differentiates with respect to the gathered
+        # columns and scatters their update back (see gather and scatter), so a step stays O(numSamples)
+        self.touched, rows = extra_ops.Unique(return_inverse=True)(T.concatenate([y, sampled]))
+        self.gathered = [self.gather(connection.w, connection.w), self.gather(connection.b, connection.b)]
+        self.trainingLogits = sampledLogits(connection.fromLayer.output, self.gathered[0], self.gathered[1],
+                                            y, sampled, rows[:y.shape[0]], rows[y.shape[0]:], logProposal)
+        return sampledNegativeLogLikelihood(self.trainingLogits)
+
+    def sparseParams(self):
+        '''
+        :return: parameters of the output connection that are only updated in their gathered columns. Valid once
+                 cost has been built
+        '''
+        connection = self.inConnections[0]
+        return [connection.w, connection.b]
+
+    def gather(self, param, value):
+        '''
+        :param param: weights or bias of the output connection
+        :param value: variable shaped like param, e.g. param itself or its pruning mask
+        :return: columns of value for the touched classes, one row per class
+        '''
+        if param is self.inConnections[0].w:
+            return value.T[self.touched]
+        return value[0][self.touched]
+
+    def scatter(self, param, value, rows):
+        '''
+        :return: value, shaped like param, with the columns of the touched classes replaced by rows
+        '''
+        if param is self.inConnections[0].w:
+            return T.set_subtensor(value.T[self.touched], rows).T
+        return T.patternbroadcast(T.set_subtensor(value[0][self.touched], rows).dimshuffle('x', 0),
+                                  value.broadcastable)
+
+    def correctCount(self, y):
+        "Return the number of examples whose true class scores above all sampled classes, without the full softmax."
+        return T.sum(T.eq(T.argmax(self.trainingLogits, axis=1), 0))
+
+class BatchNormLayer(Layer):
+    '''
+    Normalizes the aggregated input with minibatch statistics, then applies a learned scale (gamma), shift (beta)
+    and the pass function. Running averages of the statistics are updated by every training step and replace the
+    minibatch statistics in the inference graph.
+    '''
+    def __init__(self, inputShape, passFunction, aggregate_method=None, lossFunction=None, ifOutput=False,
+                 dropout=None, momentum=0.9, epsilon=1e-5, lossWeight=1.0, trainable=True, checkpoint=False):
+
+        super(BatchNormLayer,self).__init__(inputShape,passFunction,aggregate_method,dropout=dropout,
+                                            lossFunction=lossFunction,ifOutput=ifOutput,lossWeight=lossWeight,
+                                            trainable=trainable,checkpoint=checkpoint)
+        self.momentum = momentum
+        self.epsilon = epsilon
+        # Convolutional layers (channels, height, width) keep statistics per channel, other layers per neuron
+        if len(self.shape) == 3:
+            self.numOfChannels = self.shape[0]
+        else:
+            self.numOfChannels = self.numOfNeurons
+        self.gamma = None
+        self.folded = False
+
+    def initializeStatistics(self):
+
+        if self.gamma is None:
+            self.gamma = theano.shared(np.ones(self.numOfChannels, dtype=theano.config.floatX), name='gamma', borrow=True)
+            self.beta = theano.shared(np.zeros(self.numOfChannels, dtype=theano.config.floatX), name='beta', borrow=True)
+            self.runningMean = theano.shared(np.zeros(self.numOfChannels, dtype=theano.config.floatX),
+                                             name='runningMean', borrow=True)
+            self.runningVar = theano.shared(np.ones(self.numOfChannels, dtype=theano.config.floatX),
+                                            name='runningVar', borrow=True)
+
+    def normalize(self, x, mean, var):
+
+        if len(self.shape) == 3:
+            pattern = ('x', 0, 'x', 'x')
+        else:
+            pattern = ('x', 0)
+        scale = self.gamma / T.sqrt(var + self.epsilon)
+        normalized = (x - mean.dimshuffle(pattern)) * scale.dimshuffle(pattern) + self.beta.dimshuffle(pattern)
+        return normalized.reshape(self.shape_minibatch_flattened)
+
+    def run(self,minibatchSize):
+
+        self.computeShapes(minibatchSize)
+        self.inferenceReplacements = {}
+        self.input = T.zeros(shape=(minibatchSize,self.numOfNeurons))
+
+        for connection in self.inConnections:
+            connection.feedForward(minibatchSize)
+        self.aggregateInput()
+
+        for recurrentConnection in self.recurrentInConnections:
+            self.input += recurrentConnection.recurrentHiddenOutput
+
+        self.initializeStatistics()
+        if self.folded:
+            # Statistics live in the incoming connection now
+            self.normalized = self.input
+            self.params = []
+            self.updates = []
+            self.inferenceReplacements = {}
+        else:
+            if len(self.shape) == 3:
+                x = self.input.reshape(self.shape_with_minibatch)
+                axes = (0, 2, 3)
+            else:
+                x = self.input
+                axes = (0,)
+            batchMean = T.mean(x, axis=axes)
+            batchVar = T.var(x, axis=axes)
+            # Unbiased variance for the running estimate
+            numValues = minibatchSize * self.numOfNeurons / self.numOfChannels
+
+            self.normalized = self.normalize(x, batchMean, batchVar)
+            self.params = [self.gamma, self.beta]
+            self.updates = [(self.runningMean, T.cast(self.momentum*self.runningMean + (1-self.momentum)*batchMean,
+                                                      theano.config.floatX)),
+                            (self.runningVar, T.cast(self.momentum*self.runningVar +
+                                                     (1-self.momentum)*batchVar*numValues/max(numValues-1, 1),
+                                                     theano.config.floatX))]
+            self.inferenceReplacements = {self.normalized: self.normalize(x, self.runningMean, self.runningVar)}
+
+        self.preActivation = self.normalized
+        self.output = self.passFunction(self.preActivation)
 
         self.addDropout()
 
-        self.y_out = T.argmax(self.output, axis=1)
\ No newline at end of file
+        self.y_out = T.argmax(self.output, axis=1)
+
+    def fold(self):
+        '''
+        Fold the running statistics, gamma and beta into the weights of the incoming Dense or Convoluted connection,
+        so that inference runs without any normalization ops. Meant for trained networks, training afterwards
+        no longer normalizes this layer.
+        :return: None
+        '''
+        if self.folded:
+            return
+        if len(self.inConnections) != 1 or len(self.recurrentInConnections) != 0 or \
+                not isinstance(self.inConnections[0],(DenseConnection,ConvolutedConnection)):
+            raise(BatchNormFoldingNotPossible())
+        connection = self.inConnections[0]
+
+        scale = self.gamma.get_value() / np.sqrt(self.runningVar.get_value() + self.epsilon)
+        shift = self.beta.get_value() - self.runningMean.get_value() * scale
+        w = connection.w.get_value()
+        b = connection.b.get_value()
+
+        if isinstance(connection,ConvolutedConnection):
+            w = w * scale.reshape((-1, 1, 1, 1))
+        else:
+            # A Dense connection into a (channels, height, width) layer has one column per neuron
+            if len(self.shape) == 3:
+                scale = np.repeat(scale, self.numOfNeurons // self.numOfChannels)
+                shift = np.repeat(shift, self.numOfNeurons // self.numOfChannels)
+            w = w * scale.reshape((1, -1))
+            scale = scale.reshape(b.shape)
+            shift = shift.reshape(b.shape)
+
+        connection.w.set_value(np.asarray(w, dtype=theano.config.floatX))
+        connection.b.set_value(np.asarray(b * scale + shift, dtype=theano.config.floatX))
+
+        # The already built inference graph skips the normalization from now on
+        self.folded = True
+        self.params = []
+        self.updates = []
+        self.inferenceReplacements[self.normalized] = self.input
@@ -1,14 +1,26 @@
-import theano.tensor as T
+from deepLearningLibrary.backend import theano, T
 from deepLearningLibrary.activations import *
 
 from deepLearningLibrary.layers import *
 from deepLearningLibrary.connections import *
 from deepLearningLibrary.toposort import *
+from deepLearningLibrary.runtime import saveFrozenModel
+from deepLearningLibrary import analysis
+from deepLearningLibrary.validation import AsyncValidator, hostArray
+from deepLearningLibrary.augmentation import AugmentationPipeline
+from deepLearningLibrary.callbacks import *
 from pprint import pprint
+from collections import OrderedDict
 import math
 import cPickle
 import time
 
+def castTo(variable, dtype):
+    if variable.dtype == dtype:
+        return variable
+    return T.cast(variable, dtype)
+
+
 class Network(object):
 
     def __init__(self, name):
@@ -21,7 +33,9 @@ class Network(object):
         self.optimizer = None   #Optimizer Type (Currently only SGD)
         self.connections = []   #List of Connections
         self.name = name    #Initialize name of Network
-        self.outputLayer = None #Currently just one output layer
+        self.outputLayer = None #First output layer, kept for single output networks
+        self.outputLayers = []  #All output layers (heads), in feedforward order
+        self.graphOutdated = False  #Set when the layers hold another graph than the training one, see denseGraph
 
     def addLayer(self, layer):
         '''
@@ -57,12 +71,13 @@ class Network(object):
         self.connections.append(newConnection)
 
     def connectOneToOne(self, fromLayer, toLayer,
-                        regularization = None, initialization = None):
+                        regularization = None, initialization = None, trainable = True):
         '''
         :param fromLayer: Layer from which connection originates
         :param toLayer:  Layer at which connection terminates
         :param regularization:  Regularization scheme to be used for these set of weights
         :param initialization:  Initialization scheme to be used for initialization of weights
+        :param trainable:   False keeps the weights of this connection fixed while training
         :return:
         '''
 
@@ -75,16 +90,18 @@ class Network(object):
         self.updateLayersInNetwork(fromLayer,toLayer)
 
         # Create a new Connection object and update connections of network
-        c = OneToOneConnection(fromLayer, toLayer, regularization, initialization)
+        c = OneToOneConnection(fromLayer, toLayer, regularization, initialization, trainable=trainable)
         self.updateConnectionsInNetwork(fromLayer,toLayer,c)
 
-    def connectDense(self, fromLayer, toLayer, regularization = None, initialization = None,targetNeurons=None):
+    def connectDense(self, fromLayer, toLayer, regularization = None, initialization = None,targetNeurons=None,
+                     trainable = True):
         '''
         :param fromLayer: Layer from which connection originates
         :param toLayer:  Layer at which connection terminates
         :param regularization:  Regularization scheme to be used for these set of weights
         :param initialization:  Initialization scheme to be used for initialization of weights
         :param targetNeurons:   Number of Neurons to be to be used on the target layer
+        :param trainable:   False keeps the weights of this connection fixed while training
         :return:
         '''
 
@@ -99,12 +116,13 @@ class Network(object):
         self.updateLayersInNetwork(fromLayer,toLayer)
 
         # Create a new Connection object and update connections of network
-        c = DenseConnection(fromLayer, toLayer, regularization, initialization,targetNeurons=targetNeurons)
+        c = DenseConnection(fromLayer, toLayer, regularization, initialization,targetNeurons=targetNeurons,
+                            trainable=trainable)
         self.updateConnectionsInNetwork(fromLayer,toLayer,c)
 
     def connectConvolution(self, fromLayer, toLayer, input_shape, filter_shape,
                            stride_length, zero_padding, regularization = None,
-                           initialization = None):
+                           initialization = None, trainable = True):
         '''
         :param fromLayer: Layer from which connection originates
         :param toLayer:  Layer at which connection terminates
@@ -114,6 +132,7 @@ class Network(object):
         :param zero_padding:    Zero padding to be added if any to the input
         :param regularization:  Regularization scheme to be used for these set of weights
         :param initialization:  Initialization scheme to be used for initialization of weights
+        :param trainable:   False keeps the weights of this connection fixed while training
         :return:
         '''
 
@@ -132,23 +151,24 @@ class Network(object):
         # Create a new Connection object and update connections of network
         c = ConvolutedConnection(fromLayer, toLayer, regularization,
                            initialization, input_shape, filter_shape,
-                           stride_length, zero_padding)
+                           stride_length, zero_padding, trainable=trainable)
         self.updateConnectionsInNetwork(fromLayer,toLayer,c)
 
     def connectRecurrent(self,fromLayer, toLayer,
-                         regularization = None, initialization = None):
+                         regularization = None, initialization = None, trainable = True):
         '''
         :param fromLayer: Layer from which connection originates
         :param toLayer:  Layer at which connection terminates
         :param regularization:  Regularization scheme to be used for these set of weights
         :param initialization:  Initialization scheme to be used for initialization of weights
+        :param trainable:   False keeps the weights of this connection fixed while training
         :return:
         '''
         # Add Layers to self.layers if layer does not exist already
         self.updateLayersInNetwork(fromLayer,toLayer)
 
         # Create a new Connection object and update connections of network
-        c = RecurrentConnection(fromLayer, toLayer, regularization, initialization)
+        c = RecurrentConnection(fromLayer, toLayer, regularization, initialization, trainable=trainable)
         self.updateConnectionsInNetwork(fromLayer,toLayer,c)
 
     def connectMaxPool(self,fromLayer,toLayer,poolSize):
@@ -194,11 +214,22 @@ class Network(object):
             raise(OutputLayerNotDefined(self.name))
 
 
-    def compile(self, mini_batch_size):
+    def compile(self, mini_batch_size=None, memory_budget=None):
         '''
         :param mini_batch_size: batch size to be used for this network
+        :param memory_budget:   Training memory available, in bytes. The largest batch size whose estimated memory
+                                (see memoryReport) fits is used, at most mini_batch_size when that is given too
         :return:
         '''
+        if memory_budget is not None:
+            fittingBatchSize = analysis.largestBatchSize(self.layers, memory_budget, theano.config.floatX)
+            if fittingBatchSize < 1:
+                raise(MemoryBudgetExceeded(memory_budget,
+                                           self.memoryReport(1, verbose=False)['total']['total']))
+            if mini_batch_size is None or fittingBatchSize < mini_batch_size:
+                mini_batch_size = fittingBatchSize
+            print("Mini-batch size {0} fits into the memory budget".format(mini_batch_size))
+
         # Assign names to layers
         self.checkErrors(mini_batch_size)
         self.namingLayers()
@@ -206,8 +237,10 @@ class Network(object):
         # Construct a DAG out of the network
         g = constructGraph(self.layers)
 
-        # Apply toposort and get the updated order of layers in which feedforward should run
-        self.layers = topological(g)
+        # Apply toposort and get the updated order of layers in which feedforward should run. Layers of one level
+        # do not depend on each other
+        self.layerLevels = topologicalLevels(g)
+        self.layers = [layer for level in self.layerLevels for layer in level]
 
         self.mini_batch_size = mini_batch_size
 
@@ -222,9 +255,24 @@ class Network(object):
         for connection in self.connections:
             connection.initializeWeights()
 
+        self.buildGraph()
+
+    def buildGraph(self):
+        '''
+        Define the symbolic feedforward graph on the current weights. Can be called again after compile without
+        touching the weights, e.g. to run some connections differently for inference
+        :return:
+        '''
+        mini_batch_size = self.mini_batch_size
+
+        for layer in self.layers:
+            layer.initializeInputOutput(mini_batch_size)
+
+        for connection in self.connections:
             # if the connection is of type Recurrent, then run feedForward once to initialize the hidden state of
             # that connection
             if isinstance(connection,RecurrentConnection):
+                connection.recurrentHiddenState = connection.fromLayer.output
                 connection.feedForward(mini_batch_size)
 
         # Define the feedforward equations for each layer
@@ -234,9 +282,6 @@ class Network(object):
             else:
                 # Defining the input and output for each layer
                 layer.run(mini_batch_size)
-                # Assigning the output layer object of the network to the appropriate layer
-                if layer.ifOutput:
-                    self.outputLayer = layer
 
         # Update the hidden states of the recurrent connection with the new updated output of fromLayer and run
         # feedForward so that output variable of that connection gets updated
@@ -252,12 +297,220 @@ class Network(object):
                     self.outputLayer = layer
         '''
 
+        # Every output layer is a head on the shared trunk, the first one stays the network's outputLayer
+        self.outputLayers = [layer for layer in self.layers if not isinstance(layer,InputLayer) and layer.ifOutput]
+        self.outputLayer = self.outputLayers[0]
+
         # Aggregate all parameters of the network(Used for updation which backpropagation)
-        self.params = [param for connection in self.connections for param in connection.params]
+        self.params = [param for connection in self.connections for param in connection.params] + \
+                      [param for layer in self.layers for param in layer.params]
         self.output = self.outputLayer.output
+        self.outputs = [layer.output for layer in self.outputLayers]
+        self.inferenceOutput = self.inferenceGraph(self.output)
+        self.inferenceOutputs = self.inferenceGraph(self.outputs)
+        self.predictFunction = None
+        self.graphOutdated = False
+
+    def denseGraph(self):
+        '''
+        Rebuild the training graph if the layers were left with another one, e.g. by pruning.compileSparseInference
+        :return:
+        '''
+        if self.graphOutdated:
+            self.buildGraph()
+
+    def inferenceGraph(self, outputs):
+        '''
+        Rewrite (a list of) training graph expressions for inference, using the replacements registered by the
+        layers (e.g. running instead of minibatch statistics for batch normalization)
+        :param outputs: symbolic expression(s) built on the training graph
+        :return: the corresponding inference expression(s)
+        '''
+        replacements = {}
+        for layer in self.layers:
+            replacements.update(layer.inferenceReplacements)
+        if not replacements:
+            return outputs
+        return theano.clone(outputs, replace=replacements)
+
+    def foldBatchNorm(self):
+        '''
+        Fold every batch normalization layer into its incoming connection for inference, after training
+        :return:
+        '''
+        self.denseGraph()
+        for layer in self.layers:
+            if isinstance(layer,BatchNormLayer):
+                layer.fold()
+        self.params = [param for connection in self.connections for param in connection.params] + \
+                      [param for layer in self.layers for param in layer.params]
+        self.inferenceOutput = self.inferenceGraph(self.output)
+        self.inferenceOutputs = self.inferenceGraph(self.outputs)
+        self.predictFunction = None
+
+    def memoryReport(self, batch_size, optimizerSlots=0, accumulation_steps=1, verbose=True):
+        '''
+        Estimate bytes of parameters, activations, gradients and optimizer state per layer from the layer shapes
+        and connection configuration (see analysis.py). Can be used before compile
+        :param batch_size:  Mini-batch size to estimate for
+        :param optimizerSlots:  Values kept by the optimizer per trained parameter (0 for SGD)
+        :param accumulation_steps:  Gradient accumulation of fit, which keeps one buffer per trained parameter
+        :param verbose: Print the report
+        :return: the report dictionary
+        '''
+        self.namingLayers()
+        report = analysis.memoryReport(self.layers, batch_size, theano.config.floatX, optimizerSlots,
+                                       accumulation_steps)
+        if verbose:
+            analysis.printMemoryReport(report)
+        return report
+
+    def costReport(self, batch_size, step_time=None, peak_flops=None, peak_bandwidth=None, verbose=True):
+        '''
+        Estimate forward and backward FLOPs and bytes moved of a training step per layer from the layer shapes and
+        connection configuration (see analysis.py). Can be used before compile, e.g. to compare topologies
+        :param batch_size:  Mini-batch size to estimate for
+        :param step_time:   Measured seconds per training step (e.g. secondsPerStep of autotune.burst), for a
+                            roofline comparison
+        :param peak_flops:  Peak FLOP/s of the machine
+        :param peak_bandwidth:  Peak memory bandwidth of the machine in bytes/s
+        :param verbose: Print the report
+        :return: the report dictionary, with the comparison under 'roofline' if step_time is given
+        '''
+        self.namingLayers()
+        report = analysis.costReport(self.layers, batch_size, theano.config.floatX)
+        if step_time is not None:
+            report['roofline'] = analysis.roofline(report, step_time, peak_flops, peak_bandwidth)
+        if verbose:
+            analysis.printCostReport(report, report.get('roofline'))
+        return report
+
+    def trainableConnections(self):
+        '''
+        :return: connections whose weights are trained, i.e. neither the connection nor its target layer is frozen
+        '''
+        return [connection for connection in self.connections if connection.trainable and connection.toLayer.trainable]
+
+    def trainableParams(self):
+        '''
+        :return: parameters that fit differentiates and updates. Frozen parameters stay out of T.grad, so the
+                 backward pass stops at the earliest trainable connection
+        '''
+        return [param for connection in self.trainableConnections() for param in connection.params] + \
+               [param for layer in self.layers if layer.trainable for param in layer.params]
+
+    def checkpointReplacements(self):
+        '''
+        Gradient checkpointing. The graph segment computing each checkpoint layer's output from the previous
+        checkpoints (and the network input) is wrapped into a theano.OpFromGraph, whose gradient recomputes the
+        segment instead of keeping its intermediate outputs for the backward pass. Activation memory is then
+        kept for the checkpoint outputs and one segment at a time.
+        :return: dictionary checkpoint output -> rematerialized output, to be applied with theano.clone
+        '''
+        replacements = {}
+        # Boundaries are the variables a segment starts from, mapped to their rematerialized version
+        boundaries = [(self.x, self.x)]
+        for layer in self.layers:
+            if isinstance(layer,InputLayer) or not layer.checkpoint:
+                continue
+
+            # A segment is run twice, so a random dropout mask would differ between forward and backward pass
+            segment = theano.gof.graph.ancestors([layer.output], blockers=[boundary for boundary, _ in boundaries])
+            segmentVariables = set(segment)
+            for segmentLayer in self.layers:
+                if segmentLayer.dropout is not None and segmentLayer.output in segmentVariables:
+                    raise(CheckpointNotPossible(segmentLayer.name))
+
+            # Cut the segment at the boundaries it depends on and take its weights as explicit inputs
+            used = [(boundary, remat) for boundary, remat in boundaries if boundary in segmentVariables]
+            placeholders = [boundary.type() for boundary, _ in used]
+            inner = theano.clone(layer.output,
+                                 replace=dict(zip([boundary for boundary, _ in used], placeholders)))
+            shared = [variable for variable in theano.gof.graph.inputs([inner])
+                      if isinstance(variable, theano.compile.SharedVariable)]
+            sharedPlaceholders = [variable.type() for variable in shared]
+            inner = theano.clone(inner, replace=dict(zip(shared, sharedPlaceholders)))
+
+            segmentOp = theano.OpFromGraph(placeholders + sharedPlaceholders, [inner])
+            rematerialized = segmentOp(*([remat for _, remat in used] + shared))
+
+            replacements[layer.output] = rematerialized
+            boundaries.append((layer.output, rematerialized))
+        return replacements
+
+    def targets(self, data_y):
+        '''
+        :param data_y: Labels of a dataset, one set of labels per output layer (a list) or a single set of labels
+        :return: list with the labels of every output layer, in the order of self.outputLayers
+        '''
+        if not isinstance(data_y, (list, tuple)):
+            data_y = [data_y]
+        if len(data_y) != len(self.outputLayers):
+            raise(TargetsMismatch(len(self.outputLayers), len(data_y)))
+        return list(data_y)
+
+    def predict(self, data_x):
+        '''
+        Run the inference graph on data_x. The shared trunk is computed once per minibatch for all heads
+        :param data_x: Inputs (array or shared variable), one example per row
+        :return: output of the output layer, or a list with the output of every output layer (in the order of
+                 self.outputLayers) when the network has several
+        '''
+        if isinstance(data_x, theano.compile.SharedVariable):
+            data_x = data_x.get_value(borrow=True)
+        data_x = np.asarray(data_x, dtype=theano.config.floatX)
+        data_x = data_x.reshape((data_x.shape[0], -1))
+
+        self.denseGraph()
+        if self.predictFunction is None:
+            self.predictFunction = theano.function([self.x], self.inferenceOutputs, on_unused_input='ignore')
+
+        # The graph is built for mini_batch_size rows, so the last minibatch is padded
+        numExamples = data_x.shape[0]
+        numBatches = int(math.ceil(numExamples/float(self.mini_batch_size)))
+        padded = np.zeros((numBatches*self.mini_batch_size, data_x.shape[1]), dtype=data_x.dtype)
+        padded[:numExamples] = data_x
+
+        batchOutputs = [self.predictFunction(padded[j*self.mini_batch_size: (j+1)*self.mini_batch_size])
+                        for j in range(numBatches)]
+        predictions = [np.concatenate([outputs[head] for outputs in batchOutputs])[:numExamples]
+                       for head in range(len(self.outputLayers))]
+        if len(predictions) == 1:
+            return predictions[0]
+        return predictions
+
+    def lsuvInitialize(self, sample_x, tolerance=0.1, max_iterations=10):
+        '''
+        Layer-sequential unit variance initialization. Connections created with initialization='lsuv' are
+        rescaled one after the other, in feedforward order, until their output variance on a sample batch is 1
+        :param sample_x:    Sample inputs (array or shared variable), the first mini_batch_size rows are used
+        :param tolerance:   Accepted deviation of the output variance from 1
+        :param max_iterations:  Maximum number of rescaling steps per connection
+        :return:
+        '''
+        if isinstance(sample_x, theano.compile.SharedVariable):
+            sample_x = sample_x.get_value(borrow=True)
+        sample = theano.shared(np.asarray(sample_x[:self.mini_batch_size], dtype=theano.config.floatX), borrow=True)
+        self.denseGraph()
+
+        for layer in self.layers:
+            for connection in layer.inConnections:
+                if connection.initialization != 'lsuv':
+                    continue
+
+                # Earlier connections are already calibrated, so the incoming activations are final
+                outputVariance = theano.function([], T.var(connection.output), givens={self.x: sample},
+                                                 on_unused_input='ignore')
+                for iteration in range(max_iterations):
+                    variance = outputVariance()
+                    if abs(variance - 1.0) < tolerance:
+                        break
+                    connection.w.set_value(connection.w.get_value() / np.sqrt(variance + 1e-8))
 
     def fit(self, training_data, epochs, eta,
-            validation_data, test_data, lmbda=0.0):
+            validation_data, test_data, lmbda=0.0, training_metrics=False, accumulation_steps=1, pruning=None,
+            async_validation=False, patience=None, augmentation=None, augmentation_workers=2, callbacks=None,
+            steps_per_call=1):
         '''
         :param training_data:   Data to be trained on
         :param epochs:  Number of epochs the network should be run for
@@ -265,9 +518,31 @@ class Network(object):
         :param validation_data: Validation Data for parameter tuning of the network
         :param test_data:   Data for which predictions have to be made
         :param lmbda:   Regularization Constant
+        :param training_metrics:    Also return correct predictions and loss from each training step and report
+                                    epoch level training accuracy and loss (kept in self.trainingHistory), through
+                                    the TrainingMetrics callback
+        :param accumulation_steps:  Number of mini-batches whose gradients are summed before one update is applied,
+                                    for an effective batch size of accumulation_steps*mini_batch_size
+        :param pruning: MagnitudePruning schedule (see pruning.py) applied to the Dense connections while training
+        :param async_validation:    Score validation and test data in a worker process on a snapshot of the weights
+                                    (see validation.py), training continues while the epoch is scored
+        :param patience:    Stop training after this many epochs without a better validation accuracy
+        :param augmentation:    Augmentation (see augmentation.py) of the training images, prepared by worker
+                                processes while the network trains
+        :param augmentation_workers:    Number of augmentation worker processes
+        :param callbacks:   List of Callback objects (see callbacks.py), called after training steps, at the end
+                            of every epoch and for every validation result
+        :param steps_per_call:  Number of consecutive mini-batches trained by one call of the compiled training
+                                function, looping over them with theano.scan. The last mini-batches of an epoch
+                                that do not fill a call are trained one by one. Pruning takes effect at the end of
+                                a call
         :return:
+
+        With several output layers, the labels of each dataset are a list with one set of labels per output layer
+        (in the order of self.outputLayers). The network cost is the sum of the head losses weighted by lossWeight.
         '''
         """Train the network using mini-batch stochastic gradient descent."""
+        self.denseGraph()
 
         # self.mini_batch_size = mini_batch_size
         training_x, training_y = training_data
@@ -282,60 +557,235 @@ class Network(object):
         print('batch sizes')
         print(num_training_batches,num_validation_batches,num_test_batches)
 
-        self.y = T.ivector("y")
-        # define the (regularized) cost function, symbolic gradients, and updates
-        l2_norm_squared = sum([(param**2).sum() for param in self.params])
-        cost = self.outputLayer.cost(self.y,self.mini_batch_size)+0.5*lmbda*l2_norm_squared/num_training_batches
+        if steps_per_call > 1 and augmentation is not None:
+            raise(StepsPerCallNotPossible("augmented mini-batches are passed in one at a time"))
+        if steps_per_call > 1 and accumulation_steps > 1:
+            raise(StepsPerCallNotPossible("gradient accumulation applies its updates between training steps"))
 
-        grads = T.grad(cost, self.params)
-        updates = [(param, param-eta*grad)
-                   for param, grad in zip(self.params, grads)]
+        training_y = self.targets(training_y)
+        validation_y = self.targets(validation_y)
+        test_y = self.targets(test_y)
+
+        # One label vector per output layer, self.y is the one of the first output layer
+        self.ys = [T.ivector("y") for layer in self.outputLayers]
+        self.y = self.ys[0]
+        # define the (regularized) cost function, symbolic gradients, and updates
+        # Only trainable connection weights are regularized, not layer parameters such as batch normalization scales
+        trainableConnections = self.trainableConnections()
+        trainableParams = self.trainableParams()
+        headLosses = [layer.cost(y,self.mini_batch_size) for layer, y in zip(self.outputLayers, self.ys)]
+        loss = sum([layer.lossWeight*headLoss for layer, headLoss in zip(self.outputLayers, headLosses)])
+
+        # The output connection of a sampled softmax is differentiated, regularized and updated only in the
+        # columns of the classes its cost touched, param -> (layer, gathered columns)
+        sparse = {}
+        for layer in self.outputLayers:
+            if isinstance(layer,SampledSoftmaxLayer):
+                for param, gathered in zip(layer.sparseParams(), layer.gathered):
+                    if param in trainableParams:
+                        sparse[param] = (layer, gathered)
+        gradParams = [sparse[param][1] if param in sparse else param for param in trainableParams]
+        l2_norm_squared = sum([((sparse[param][1] if param in sparse else param)**2).sum()
+                               for connection in trainableConnections for param in connection.params])
+        cost = loss+0.5*lmbda*l2_norm_squared/num_training_batches
+
+        # Layers between checkpoints are recomputed by the backward pass of the training graph
+        checkpoints = self.checkpointReplacements()
+        if checkpoints:
+            # Gathered columns are cloned along, so that the gradient is taken in the cloned graph
+            cloned = theano.clone([cost] + gradParams, replace=checkpoints)
+            cost, gradParams = cloned[0], cloned[1:]
+
+        grads = T.grad(cost, gradParams)
+
+        # Pruned weights are kept at zero by masking their updates
+        masks = {}
+        if pruning is not None:
+            masks = pruning.initializeMasks(trainableConnections)
+        def masked(param, value, gathered=False):
+            if param in masks:
+                if gathered:
+                    return value*sparse[param][0].gather(param, masks[param])
+                return value*masks[param]
+            return value
+
+        if accumulation_steps > 1:
+            # Each training step only adds its gradients to the buffers, apply_mb takes the averaged step
+            gradBuffers = [theano.shared(np.zeros_like(param.get_value()), broadcastable=param.broadcastable)
+                           for param in trainableParams]
+            updates = []
+            for param, gradBuffer, grad in zip(trainableParams, gradBuffers, grads):
+                if param in sparse:
+                    layer = sparse[param][0]
+                    updates.append((gradBuffer, layer.scatter(param, gradBuffer,
+                                                              layer.gather(param, gradBuffer)+grad)))
+                else:
+                    updates.append((gradBuffer, gradBuffer+grad))
+
+            numAccumulated = T.scalar()
+            apply_mb = theano.function(
+                [numAccumulated], [],
+                updates=[(param, masked(param, param-eta*gradBuffer/numAccumulated))
+                         for param, gradBuffer in zip(trainableParams, gradBuffers)] +
+                        [(gradBuffer, T.zeros_like(gradBuffer)) for gradBuffer in gradBuffers])
+        else:
+            updates = []
+            for param, gradParam, grad in zip(trainableParams, gradParams, grads):
+                if param in sparse:
+                    updates.append((param, sparse[param][0].scatter(param, param,
+                                                                    masked(param, gradParam-eta*grad, True))))
+                else:
+                    updates.append((param, masked(param, param-eta*grad)))
+        # State kept by layers themselves, e.g. running statistics of batch normalization. Frozen layers keep theirs
+        updates += [update for layer in self.layers if layer.trainable for update in layer.updates]
 
         # define functions to train a mini-batch, and to compute the
         # accuracy in validation and test mini-batches.
         i = T.lscalar() # mini-batch index
 
-        train_mb = theano.function(
-            [i],
-            [cost,self.layers[-1].output,self.layers[-1].input,self.connections[-1].w],
-            updates=updates,
-            givens={
-                self.x:
-                training_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y:
-                training_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            },on_unused_input='ignore')
+        # The step only returns the cost, callbacks ask for more every few steps
+        callbacks = list(callbacks or [])
+        if training_metrics:
+            callbacks.append(TrainingMetrics())
+        self.loss = loss
+        self.cost = cost
+        fetches = []
+        fetchSlices = []
+        for callback in callbacks:
+            callbackFetches = callback.fetches(self)
+            fetchSlices.append(slice(len(fetches), len(fetches)+len(callbackFetches)))
+            fetches += callbackFetches
+        if checkpoints and fetches:
+            fetches = theano.clone(fetches, replace=checkpoints)
+
+        def minibatchGivens(data_x, data_y, index=i):
+            # Compactly stored datasets (e.g. uint8 inputs and labels) are cast one minibatch at a time
+            batch = slice(index*self.mini_batch_size, (index+1)*self.mini_batch_size)
+            givens = {self.x: castTo(data_x[batch], self.x.dtype)}
+            for y, head_y in zip(self.ys, data_y):
+                givens[y] = castTo(head_y[batch], y.dtype)
+            return givens
+
+        def multiStepFunction(outputs):
+            # Trains steps_per_call mini-batches from the index it is called with, applying the updates after each
+            def scanStep(index):
+                replace = minibatchGivens(training_x, training_y, index)
+                stepValues = theano.clone(outputs + [value for param, value in updates], replace=replace)
+                return stepValues[:len(outputs)], OrderedDict(zip([param for param, value in updates],
+                                                                  stepValues[len(outputs):]))
+            first = T.lscalar()
+            stepOutputs, stepUpdates = theano.scan(scanStep, sequences=T.arange(first, first+steps_per_call))
+            if not isinstance(stepOutputs, list):
+                stepOutputs = [stepOutputs]
+            return theano.function([first], stepOutputs, updates=stepUpdates, on_unused_input='ignore')
+
+        if augmentation is not None:
+            # Augmented mini-batches come from the workers' shared memory ring and are passed in as inputs
+            trainInputs, trainGivens = [self.x] + self.ys, None
+        else:
+            trainInputs, trainGivens = [i], minibatchGivens(training_x, training_y)
+
+        def trainFunction(outputs):
+            return theano.function(
+                trainInputs,
+                outputs,
+                updates=updates,
+                givens=trainGivens,
+                on_unused_input='ignore')
+
+        # Each step function exists without and with the fetches of the callbacks, the latter is used when a
+        # callback with fetches is due. Only the variants the training loop can select are compiled: single steps
+        # are needed for the mini-batches of an epoch that do not fill a multi-step call, and the variant without
+        # fetches only if some step (or call) has no such callback due
+        fetchFrequencies = [callback.frequency for callback, fetchSlice in zip(callbacks, fetchSlices)
+                            if fetchSlice.stop > fetchSlice.start]
+        multiStep = steps_per_call > 1 and num_training_batches >= steps_per_call
+        train_mb, train_mb_fetches, train_steps, train_steps_fetches = None, None, None, None
+        if not multiStep or num_training_batches % steps_per_call != 0:
+            if not fetches or min(fetchFrequencies) > 1:
+                train_mb = trainFunction([cost])
+            if fetches:
+                train_mb_fetches = trainFunction([cost] + fetches)
+        if multiStep:
+            # One value per step for every output. A callback with a frequency up to steps_per_call is due at some
+            # step of every call
+            if not fetches or min(fetchFrequencies) > steps_per_call:
+                train_steps = multiStepFunction([cost])
+            if fetches:
+                train_steps_fetches = multiStepFunction([cost] + fetches)
+
+        def selectStep(plain, fetching, fetchesDue):
+            if (fetchesDue and fetching is not None) or plain is None:
+                return fetching
+            return plain
 
         # theano.printing.pydotprint(train_mb,outfile='graph.png',format='png')
+        # Accuracies of all heads come from one pass through the shared trunk
+        headAccuracies = [layer.accuracy(y) for layer, y in zip(self.outputLayers, self.ys)]
         validate_mb_accuracy = theano.function(
-            [i], self.layers[-1].accuracy(self.y),
-            givens={
-                self.x:
-                validation_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y:
-                validation_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            },on_unused_input='ignore')
+            [i], self.inferenceGraph(headAccuracies),
+            givens=minibatchGivens(validation_x, validation_y),
+            on_unused_input='ignore')
         test_mb_accuracy = theano.function(
-            [i], self.layers[-1].accuracy(self.y),
-            givens={
-                self.x:
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size],
-                self.y:
-                test_y[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            },on_unused_input='ignore')
-        test_mb_predictions = theano.function(
-            [i], [self.layers[-1].output
-                ,
-                  self.layers[-2].output
-                  ],
-            givens={
-                self.x:
-                test_x[i*self.mini_batch_size: (i+1)*self.mini_batch_size]
-            },on_unused_input='ignore')
-
+            [i], self.inferenceGraph(headAccuracies),
+            givens=minibatchGivens(test_x, test_y),
+            on_unused_input='ignore')
 
         # Do the actual training
-        best_validation_accuracy = 0.0
+        # Best validation accuracy so far, updated as validation results come in
+        best = {'accuracy': 0.0, 'iteration': 0, 'epoch': 0, 'testAccuracy': 0.0, 'lastEpoch': -1}
+        self.trainingHistory = []
+
+        def validationResult(result):
+            # With several heads the mean of their accuracies selects the best epoch
+            validation_accuracy = np.mean(result['headAccuracies'])
+            print("Epoch {0}: validation accuracy {1:.2%}".format(
+                result['epoch'], validation_accuracy))
+            if len(self.outputLayers) > 1:
+                for layer, head_accuracy in zip(self.outputLayers, result['headAccuracies']):
+                    print("    {0}: {1:.2%}".format(layer.name, head_accuracy))
+            best['lastEpoch'] = result['epoch']
+            for callback in callbacks:
+                callback.onValidation(self, result)
+
+            if validation_accuracy > best['accuracy']:
+                print("This is the best validation accuracy to date.")
+                best.update({'accuracy': validation_accuracy, 'iteration': result['iteration'],
+                             'epoch': result['epoch']})
+
+                '''
+                # Save Model for future reference
+                for eachConnection in self.connections:
+                    connectionName = eachConnection.toLayer.name + "+" + eachConnection.fromLayer.name
+                    print connectionName
+                    fileName = "../data/weights/" + self.name + "_EpochNum_" + str(epoch) + "_accuracy_" + str(best_validation_accuracy*100) + connectionName + ".pickle"
+                    #dictToSave[connectionName] = eachConnection.params
+                    #dictToSave[connectionName] = [param.get_value() for param in eachConnection.params]
+                    saveList = eachConnection.params
+                    print fileName
+                    with open(fileName, 'wb') as handle:
+                        cPickle.dump(saveList, handle, protocol=cPickle.HIGHEST_PROTOCOL)
+
+                #To Load
+                #with open(filename.pickle, 'rb') as handle:
+                #    unserialized_data = pickle.load(handle)
+                '''
+                '''
+                yn = raw_input("Do you want to check??? ")
+                if(yn == "T"):
+                    while(raw_input("Please type character $ when done : else, the code pauses for 2 seconds") != "$"):
+                        time.sleep(2)
+                        break
+                '''
+                if 'testAccuracy' in result:
+                    best['testAccuracy'] = result['testAccuracy']
+                elif test_data:
+                    best['testAccuracy'] = np.mean(
+                        [test_mb_accuracy(j) for j in range(num_test_batches)])
+                print('The corresponding test accuracy is {0:.2%}'.format(
+                    best['testAccuracy']))
+
+        stopped = False
         '''
         if(savingFrequency == 0):
             #lets keep saving and overwriting after every 20% percent of epochs
@@ -343,64 +793,97 @@ class Network(object):
             if(savingFrequency == 0):
                 savingFrequency = 1
         '''
-        for epoch in range(epochs):
-            tic = time.time()
-            for minibatch_index in range(num_training_batches):
-                iteration = num_training_batches*epoch+minibatch_index
-                if iteration % 1000 == 0:
-                    print("Training mini-batch number {0}".format(iteration))
-                cost_ij, output, input, lastConnectionWeights = train_mb(minibatch_index)
-                if (iteration+1) % num_training_batches == 0:
-                    validation_accuracy = np.mean(
-                        [validate_mb_accuracy(j) for j in range(num_validation_batches)])
-                    print("Epoch {0}: validation accuracy {1:.2%}".format(
-                        epoch, validation_accuracy))
-                    print("Corresponding Loss : ",cost_ij)
-
-                    if validation_accuracy > best_validation_accuracy:
-                        print("This is the best validation accuracy to date.")
-                        best_validation_accuracy = validation_accuracy
-                        best_iteration = iteration
-
-                        '''
-                        # Save Model for future reference
-                        for eachConnection in self.connections:
-                            connectionName = eachConnection.toLayer.name + "+" + eachConnection.fromLayer.name
-                            print connectionName
-                            fileName = "../data/weights/" + self.name + "_EpochNum_" + str(epoch) + "_accuracy_" + str(best_validation_accuracy*100) + connectionName + ".pickle"
-                            #dictToSave[connectionName] = eachConnection.params
-                            #dictToSave[connectionName] = [param.get_value() for param in eachConnection.params]
-                            saveList = eachConnection.params
-                            print fileName
-                            with open(fileName, 'wb') as handle:
-                                cPickle.dump(saveList, handle, protocol=cPickle.HIGHEST_PROTOCOL)
-
-                        #To Load
-                        #with open(filename.pickle, 'rb') as handle:
-                        #    unserialized_data = pickle.load(handle)
-                        '''
-                        '''
-                        yn = raw_input("Do you want to check??? ")
-                        if(yn == "T"):
-                            while(raw_input("Please type character $ when done : else, the code pauses for 2 seconds") != "$"):
-                                time.sleep(2)
-                                break
-                        '''
-                        if test_data:
-                            test_accuracy = np.mean(
-                                [test_mb_accuracy(j) for j in range(num_test_batches)])
-                            print('The corresponding test accuracy is {0:.2%}'.format(
-                                test_accuracy))
-
-                    '''Debug prints'''
-                    preds = test_mb_predictions(0)
-                    # print preds[0],preds[1]
-
-            print time.time() - tic
+        # The worker processes are closed whichever way training ends, otherwise an error or an interrupt leaves
+        # them running and the shared memory of the augmentation ring allocated
+        validator = None
+        pipeline = None
+        try:
+            if async_validation:
+                numValidation = num_validation_batches*self.mini_batch_size
+                numTest = num_test_batches*self.mini_batch_size
+                validator = AsyncValidator(
+                    (hostArray(validation_x)[:numValidation], [hostArray(y)[:numValidation] for y in validation_y]),
+                    (hostArray(test_x)[:numTest], [hostArray(y)[:numTest] for y in test_y]))
+            if augmentation is not None:
+                pipeline = AugmentationPipeline(hostArray(training_x), [hostArray(y) for y in training_y],
+                                                self.inputLayer.shape, self.mini_batch_size, augmentation,
+                                                augmentation_workers)
+
+            for epoch in range(epochs):
+                if stopped:
+                    break
+                tic = time.time()
+                # Outputs of the remaining steps of the last multi-step call
+                stepOutputs = []
+                for minibatch_index in range(num_training_batches):
+                    iteration = num_training_batches*epoch+minibatch_index
+                    if iteration % 1000 == 0:
+                        print("Training mini-batch number {0}".format(iteration))
+                    due = [callback.due(iteration) for callback in callbacks]
+                    if stepOutputs:
+                        trainOutputs = stepOutputs.pop(0)
+                    elif multiStep and minibatch_index + steps_per_call <= num_training_batches:
+                        step = selectStep(train_steps, train_steps_fetches,
+                                          any([callback.due(iteration+k) and fetchSlice.stop > fetchSlice.start
+                                               for k in range(steps_per_call)
+                                               for callback, fetchSlice in zip(callbacks, fetchSlices)]))
+                        callOutputs = step(minibatch_index)
+                        stepOutputs = [[output[k] for output in callOutputs] for k in range(steps_per_call)]
+                        trainOutputs = stepOutputs.pop(0)
+                    else:
+                        step = selectStep(train_mb, train_mb_fetches,
+                                          any([isDue and fetchSlice.stop > fetchSlice.start
+                                               for isDue, fetchSlice in zip(due, fetchSlices)]))
+                        if augmentation is not None:
+                            batch_x, batch_ys = pipeline.next()
+                            trainOutputs = step(batch_x, *batch_ys)
+                            pipeline.release()
+                        else:
+                            trainOutputs = step(minibatch_index)
+                    cost_ij, values = trainOutputs[0], trainOutputs[1:]
+                    for callback, isDue, fetchSlice in zip(callbacks, due, fetchSlices):
+                        if isDue:
+                            callback.onStep(self, iteration, cost_ij, values[fetchSlice] if values else [])
+                    if accumulation_steps > 1:
+                        # The last, possibly shorter, group of an epoch is applied before validation
+                        if (minibatch_index+1) % accumulation_steps == 0 or minibatch_index == num_training_batches-1:
+                            apply_mb(float(minibatch_index % accumulation_steps + 1))
+                    if pruning is not None:
+                        pruning.step(iteration, num_training_batches)
+                    if (iteration+1) % num_training_batches == 0:
+                        for callback in callbacks:
+                            callback.onEpochEnd(self, epoch)
+                        if validator is not None:
+                            # The worker scores a snapshot of this epoch, its results arrive while training continues
+                            snapshotLayers, snapshotConnections = self.graphSpecification()
+                            validator.submit(epoch, iteration, snapshotLayers, snapshotConnections)
+                            validationResults = validator.poll()
+                        else:
+                            validationResults = [{'epoch': epoch, 'iteration': iteration,
+                                                  'headAccuracies': list(np.mean(
+                                                      [validate_mb_accuracy(j) for j in range(num_validation_batches)],
+                                                      axis=0))}]
+                        print("Corresponding Loss : ",cost_ij)
+                        for result in validationResults:
+                            validationResult(result)
+                        if patience is not None and best['lastEpoch'] - best['epoch'] >= patience:
+                            print("No better validation accuracy for {0} epochs, stopping early".format(patience))
+                            stopped = True
+                            break
+
+                print time.time() - tic
+            if validator is not None:
+                for result in validator.poll(block=True):
+                    validationResult(result)
+        finally:
+            if validator is not None:
+                validator.close()
+            if pipeline is not None:
+                pipeline.close()
         print("Finished training network.")
         print("Best validation accuracy of {0:.2%} obtained at iteration {1}".format(
-            best_validation_accuracy, best_iteration))
-        print("Corresponding test accuracy of {0:.2%}".format(test_accuracy))
+            best['accuracy'], best['iteration']))
+        print("Corresponding test accuracy of {0:.2%}".format(best['testAccuracy']))
 
     '''
     Everything below this is work in progress
@@ -525,6 +1008,65 @@ class Network(object):
         # print('loaded weight',self.connections[-1].w.eval())
         self.params = [param for connection in self.connections for param in connection.params]
 
+    def graphSpecification(self):
+        '''
+        Describe the compiled network with plain dictionaries holding NumPy weights, as used by the NumPy kernels
+        (kernels.py), the quantization and the exported frozen models
+        :return: (layers in feedforward order, connections)
+        '''
+        connectionIndex = dict((id(connection), index) for index, connection in enumerate(self.connections))
+
+        connections = []
+        for connection in self.connections:
+            spec = {'from': connection.fromLayer.name, 'to': connection.toLayer.name,
+                    'targetNeurons': connection.targetNeurons}
+            if isinstance(connection,DenseConnection):
+                spec.update({'type': 'dense', 'w': connection.w.get_value(), 'b': connection.b.get_value()})
+            elif isinstance(connection,OneToOneConnection):
+                spec.update({'type': 'oneToOne', 'w': connection.w.get_value()})
+            elif isinstance(connection,ConvolutedConnection):
+                spec.update({'type': 'convolution', 'w': connection.w.get_value(), 'b': connection.b.get_value(),
+                             'fromShape': tuple(connection.fromLayer.shape), 'stride': tuple(connection.stride_length),
+                             'padding': connection.zero_padding})
+            elif isinstance(connection,MaxPoolingConnection):
+                spec.update({'type': 'maxPool', 'poolSize': tuple(connection.poolSize),
+                             'fromShape': tuple(connection.fromLayer.shape)})
+            elif isinstance(connection,RecurrentConnection):
+                spec.update({'type': 'recurrent', 'w': connection.w.get_value(), 'b': connection.b.get_value()})
+            connections.append(spec)
+
+        levelIndex = dict((id(layer), index) for index, level in enumerate(self.layerLevels) for layer in level)
+
+        layers = []
+        for layer in self.layers:
+            spec = {'name': layer.name, 'shape': tuple(layer.shape), 'passFunction': layer.passFunction.__name__,
+                    'level': levelIndex[id(layer)],
+                    'aggregate_method': layer.aggregate_method, 'ifOutput': layer.ifOutput,
+                    'inConnections': [connectionIndex[id(connection)] for connection in layer.inConnections],
+                    'recurrentInConnections': [connectionIndex[id(connection)]
+                                               for connection in layer.recurrentInConnections]}
+            if isinstance(layer,InputLayer):
+                spec.update({'kind': 'input', 'scale': layer.scale, 'mean': layer.mean})
+            elif isinstance(layer,BatchNormLayer):
+                spec.update({'kind': 'batchNorm', 'folded': layer.folded, 'epsilon': layer.epsilon,
+                             'gamma': layer.gamma.get_value(), 'beta': layer.beta.get_value(),
+                             'runningMean': layer.runningMean.get_value(), 'runningVar': layer.runningVar.get_value()})
+            else:
+                spec['kind'] = 'activation'
+            layers.append(spec)
+
+        return layers, connections
+
+    def export(self, path):
+        '''
+        Write the trained network (feedforward order, shapes, activations and weights) into one file that
+        runtime.loadFrozenModel runs with NumPy only
+        :param path: File to write, conventionally ending in .npz
+        :return:
+        '''
+        layers, connections = self.graphSpecification()
+        saveFrozenModel(path, layers, connections)
+
     def size(self,data):
         "Return the size of the dataset `data`."
         return data[0].get_value(borrow=True).shape[0]
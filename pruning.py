@@ -0,0 +1,158 @@
+import numpy as np
+import scipy.sparse
+from deepLearningLibrary.backend import theano, theanoSparse
+from deepLearningLibrary.connections import *
+
+''' Magnitude pruning of DenseConnection weights during training, and sparse storage/inference of the result '''
+
+class MagnitudePruning(object):
+    '''
+    Gradual magnitude pruning (Zhu & Gupta, 2017). The sparsity of every DenseConnection grows from
+    initialSparsity to targetSparsity between startEpoch and endEpoch along a cubic schedule. At each pruning step
+    the smallest magnitude weights of each connection are masked, and fit keeps masked weights at zero.
+    '''
+    def __init__(self, targetSparsity, startEpoch=0, endEpoch=None, frequency=100, initialSparsity=0.0):
+        '''
+        :param targetSparsity: Fraction of the weights of every DenseConnection pruned at the end
+        :param startEpoch: Epoch at which pruning starts
+        :param endEpoch: Epoch at which targetSparsity is reached (startEpoch+1 if None)
+        :param frequency: Number of training steps between pruning steps
+        :param initialSparsity: Sparsity of the first pruning step
+        '''
+        if endEpoch is None:
+            endEpoch = startEpoch + 1
+        self.targetSparsity = targetSparsity
+        self.initialSparsity = initialSparsity
+        self.startEpoch = startEpoch
+        self.endEpoch = endEpoch
+        self.frequency = frequency
+        self.connections = []
+
+    def initializeMasks(self, connections):
+        '''
+        Give every DenseConnection a mask
+        :return: dictionary weight -> mask, used by fit to keep pruned weights at zero
+        '''
+        self.connections = [connection for connection in connections if isinstance(connection,DenseConnection)]
+        for connection in self.connections:
+            if connection.mask is None:
+                connection.mask = theano.shared(np.ones_like(connection.w.get_value()), name='mask', borrow=True)
+        return dict((connection.w, connection.mask) for connection in self.connections)
+
+    def sparsity(self, iteration, stepsPerEpoch):
+        start = self.startEpoch * stepsPerEpoch
+        end = self.endEpoch * stepsPerEpoch
+        progress = min(1.0, (iteration - start) / float(max(end - start, 1)))
+        return self.targetSparsity + (self.initialSparsity - self.targetSparsity) * (1.0 - progress) ** 3
+
+    def step(self, iteration, stepsPerEpoch):
+        '''
+        Called by fit after every training step, prunes every frequency steps while the schedule is running
+        '''
+        start = self.startEpoch * stepsPerEpoch
+        end = self.endEpoch * stepsPerEpoch
+        if iteration < start or iteration > end:
+            return
+        if (iteration - start) % self.frequency != 0 and iteration != end:
+            return
+
+        sparsity = self.sparsity(iteration, stepsPerEpoch)
+        for connection in self.connections:
+            self.pruneConnection(connection, sparsity)
+
+    def pruneConnection(self, connection, sparsity):
+        w = connection.w.get_value()
+        numPruned = int(sparsity * w.size)
+        mask = np.ones(w.size, dtype=w.dtype)
+        if numPruned > 0:
+            # Already pruned weights are zero, so they stay among the smallest ones
+            mask[np.argpartition(np.abs(w).ravel(), numPruned - 1)[:numPruned]] = 0
+        mask = mask.reshape(w.shape)
+
+        connection.mask.set_value(mask)
+        connection.w.set_value(w * mask)
+
+
+def connectionSparsity(connection):
+    w = connection.w.get_value(borrow=True)
+    return 1.0 - np.count_nonzero(w) / float(w.size)
+
+
+def sparseConnections(network, minSparsity):
+    # Below some sparsity the dense kernels are faster than the sparse ones
+    return [connection for connection in network.connections
+            if isinstance(connection,DenseConnection) and connectionSparsity(connection) >= minSparsity]
+
+
+def saveSparseWeights(network, fileName, format='csr', blockSize=(4,4), minSparsity=0.5):
+    '''
+    Save the pruned DenseConnection weights of a trained network in CSR or block sparse (BSR) form, and all other
+    parameters densely, into one .npz file
+    :param format: 'csr' or 'bsr'
+    :param blockSize: Block shape for 'bsr', must divide the weight matrix shapes
+    :param minSparsity: Connections less sparse than this are stored densely
+    '''
+    arrays = {}
+    sparse = set(id(connection) for connection in sparseConnections(network, minSparsity))
+    for connection in network.connections:
+        connectionName = connection.toLayer.name + "+" + connection.fromLayer.name
+        if id(connection) in sparse:
+            if format == 'bsr':
+                matrix = scipy.sparse.bsr_matrix(connection.w.get_value(), blocksize=blockSize)
+                arrays[connectionName + "/blocksize"] = np.asarray(matrix.blocksize)
+            else:
+                matrix = scipy.sparse.csr_matrix(connection.w.get_value())
+            arrays[connectionName + "/data"] = matrix.data
+            arrays[connectionName + "/indices"] = matrix.indices
+            arrays[connectionName + "/indptr"] = matrix.indptr
+            arrays[connectionName + "/shape"] = np.asarray(matrix.shape)
+            arrays[connectionName + "/b"] = connection.b.get_value()
+        else:
+            for index, param in enumerate(connection.params):
+                arrays[connectionName + "/param%d" % index] = param.get_value()
+    np.savez(fileName, **arrays)
+
+
+def loadSparseWeights(network, fileName):
+    '''
+    Load weights saved by saveSparseWeights into a compiled network. Pruned connections get their masks back, so
+    training can continue without reviving pruned weights
+    '''
+    arrays = np.load(fileName)
+    for connection in network.connections:
+        connectionName = connection.toLayer.name + "+" + connection.fromLayer.name
+        if connectionName + "/data" in arrays.files:
+            components = (arrays[connectionName + "/data"], arrays[connectionName + "/indices"],
+                          arrays[connectionName + "/indptr"])
+            shape = tuple(arrays[connectionName + "/shape"])
+            if connectionName + "/blocksize" in arrays.files:
+                matrix = scipy.sparse.bsr_matrix(components, shape=shape)
+            else:
+                matrix = scipy.sparse.csr_matrix(components, shape=shape)
+            w = np.asarray(matrix.toarray(), dtype=theano.config.floatX)
+            connection.w.set_value(w)
+            connection.b.set_value(arrays[connectionName + "/b"])
+            if connection.mask is None:
+                connection.mask = theano.shared(np.ones_like(w), name='mask', borrow=True)
+            connection.mask.set_value(np.asarray(w != 0, dtype=theano.config.floatX))
+        else:
+            for index, param in enumerate(connection.params):
+                param.set_value(arrays[connectionName + "/param%d" % index])
+
+
+def compileSparseInference(network, minSparsity=0.5):
+    '''
+    Compile an inference function in which pruned DenseConnections multiply with a CSR copy of their weights
+    :return: theano function from a (mini_batch_size x inputs) array to the network output
+    '''
+    connections = sparseConnections(network, minSparsity)
+    for connection in connections:
+        connection.sparseWeights = theanoSparse.shared(scipy.sparse.csr_matrix(connection.w.get_value()))
+    network.buildGraph()
+    predict = theano.function([network.x], network.inferenceOutput)
+
+    # The dense, trainable graph is only rebuilt when the network is used again (see Network.denseGraph)
+    for connection in connections:
+        connection.sparseWeights = None
+    network.graphOutdated = True
+    return predict
@@ -0,0 +1,135 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from deepLearningLibrary.backend import theano
+from deepLearningLibrary import kernels
+
+''' Post-training int8 quantization of Dense and Convoluted connection weights, executed with NumPy kernels '''
+
+def quantizePerChannel(w, axis):
+    '''
+    Symmetric int8 quantization with one scale per slice of w along axis
+    :return: (int8 weights, float32 scales broadcastable against w)
+    '''
+    reduceAxes = tuple(a for a in range(w.ndim) if a != axis)
+    scale = np.max(np.abs(w), axis=reduceAxes, keepdims=True) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+class QuantizedModel(object):
+    '''
+    Inference engine for a quantized network. With kernel='integer' the inputs of Dense and Convoluted connections
+    are quantized to int8 with their calibrated scale and multiplied with the int8 weights. The int8 values are
+    held in float32 for the product, so it runs through BLAS and stays exact while the products summed per output
+    (K*127*127) fit into the 24 bit float32 mantissa, in float64 otherwise. With kernel='dequantize' only the
+    weights are quantized, expanded once to float32 when the model is created.
+    '''
+    def __init__(self, layers, connections, kernel='integer', threads=1):
+        if kernel not in ('integer', 'dequantize'):
+            raise ValueError('Unknown quantized kernel %s' % kernel)
+        self.layers = layers
+        self.connections = connections
+        self.kernel = kernel
+        # Independent branches of the network run concurrently on this pool
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.outputLayer = [layer['name'] for layer in layers if layer['ifOutput']][0]
+        # Weights in the form the product uses, prepared once per connection
+        self.productWeights = {}
+        for connection in connections:
+            if 'wq' in connection:
+                self.productWeights[id(connection)] = self.prepareWeights(connection)
+
+    def prepareWeights(self, connection):
+        '''
+        :return: float32 weights for kernel='dequantize', else the int8 weights as a float matrix (inputs x outputs)
+        '''
+        w = connection['wq']
+        if self.kernel == 'dequantize':
+            return w.astype(np.float32) * connection['wScale']
+        if connection['type'] == 'dense':
+            matrix = w
+        else:
+            matrix = kernels.flipFilters(w).reshape((w.shape[0], -1)).T
+        dtype = np.float32 if matrix.shape[0] * 127 * 127 < 2 ** 24 else np.float64
+        return np.ascontiguousarray(matrix, dtype=dtype)
+
+    def connectionForward(self, connection, x):
+
+        if 'wq' not in connection:
+            return kernels.connectionForward(connection, x)
+
+        weights = self.productWeights[id(connection)]
+        if self.kernel == 'dequantize':
+            floatConnection = dict(connection)
+            floatConnection['w'] = weights
+            return kernels.connectionForward(floatConnection, x)
+
+        inputScale = connection['inputScale']
+        # Integer values, held in the float dtype of the weights
+        xq = np.clip(np.round(x / inputScale), -127, 127).astype(weights.dtype)
+        if connection['type'] == 'dense':
+            accumulated = np.dot(xq, weights)
+            return (accumulated * (inputScale * connection['wScale']) + connection['b']).astype(np.float32)
+
+        images = xq.reshape((x.shape[0],) + tuple(connection['fromShape']))
+        w = connection['wq']
+        patches = kernels.im2col(kernels.pad2d(images, connection['padding']), w.shape[2], w.shape[3],
+                                 connection['stride'])
+        accumulated = np.dot(patches, weights)
+        out = accumulated * (inputScale * connection['wScale'].ravel()) + connection['b']
+        return out.transpose((0, 3, 1, 2)).reshape((x.shape[0], -1)).astype(np.float32)
+
+    def predict(self, x):
+        '''
+        :param x: minibatch of inputs (examples x input neurons), any number of examples
+        :return: output of the output layer
+        '''
+        x = np.asarray(x, dtype=np.float32)
+        return kernels.forward(self.layers, self.connections, x, self.connectionForward, self.pool)[self.outputLayer]
+
+    def weightBytes(self):
+        '''
+        :return: (bytes of the float weights replaced by int8, bytes of the int8 weights and their scales)
+        '''
+        floatBytes = sum(connection['wq'].size * 4 for connection in self.connections if 'wq' in connection)
+        quantizedBytes = sum(connection['wq'].nbytes + connection['wScale'].nbytes
+                             for connection in self.connections if 'wq' in connection)
+        return floatBytes, quantizedBytes
+
+
+def quantizeNetwork(network, sample_x, kernel='integer', percentile=100.0, batchSize=None, threads=1):
+    '''
+    Quantize the Dense and Convoluted connections of a trained, compiled network
+    :param sample_x: Calibration inputs (array or shared variable)
+    :param kernel: 'integer' or 'dequantize', see QuantizedModel
+    :param percentile: Percentile of the absolute calibration inputs mapped to 127, below 100 clips outliers
+    :param batchSize: Examples per calibration pass (mini_batch_size if None)
+    :param threads: Threads of the returned model, see QuantizedModel
+    :return: QuantizedModel
+    '''
+    if isinstance(sample_x, theano.compile.SharedVariable):
+        sample_x = sample_x.get_value(borrow=True)
+    sample_x = np.asarray(sample_x, dtype=np.float32)
+    if batchSize is None:
+        batchSize = network.mini_batch_size
+
+    layers, connections = network.graphSpecification()
+    quantized = [connection for connection in connections if connection['type'] in ('dense', 'convolution')]
+
+    # Calibrate the input range of every quantized connection on the float network
+    inputRanges = dict((id(connection), []) for connection in quantized)
+    for start in range(0, sample_x.shape[0], batchSize):
+        outputs = kernels.forward(layers, connections, sample_x[start:start + batchSize])
+        for connection in quantized:
+            inputRanges[id(connection)].append(np.percentile(np.abs(outputs[connection['from']]), percentile))
+
+    for connection in quantized:
+        inputScale = max(inputRanges[id(connection)]) / 127.0
+        connection['inputScale'] = np.float32(inputScale if inputScale > 0 else 1.0)
+        # One scale per output neuron (columns of dense weights) or per filter
+        axis = 1 if connection['type'] == 'dense' else 0
+        connection['wq'], connection['wScale'] = quantizePerChannel(connection['w'], axis)
+        del connection['w']
+
+    return QuantizedModel(layers, connections, kernel, threads)
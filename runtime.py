@@ -0,0 +1,94 @@
+import json
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from deepLearningLibrary import kernels
+
+'''
+Frozen models: a trained network written by Network.export into a single .npz file, holding a JSON description of
+the layers and connections in feedforward order next to the weight arrays. Loading and running a frozen model only
+needs NumPy.
+'''
+
+formatVersion = 1
+
+def saveFrozenModel(path, layers, connections):
+    '''
+    :param layers: layer descriptions in feedforward order (see Network.graphSpecification)
+    :param connections: connection descriptions, referenced by index from the layers
+    '''
+    arrays = {}
+
+    def describe(specs, prefix):
+        described = []
+        for index, spec in enumerate(specs):
+            spec = dict(spec)
+            for key, value in spec.items():
+                if isinstance(value, np.ndarray):
+                    arrayName = '%s%d/%s' % (prefix, index, key)
+                    arrays[arrayName] = value
+                    spec[key] = {'array': arrayName}
+            described.append(spec)
+        return described
+
+    graph = {'version': formatVersion,
+             'layers': describe(layers, 'layer'),
+             'connections': describe(connections, 'connection')}
+    arrays['graph'] = np.array(json.dumps(graph))
+    with open(path, 'wb') as handle:
+        np.savez(handle, **arrays)
+
+
+def loadFrozenModel(path, threads=1):
+    '''
+    :param path: File written by Network.export
+    :param threads: Number of threads running independent branches of the network concurrently
+    :return: FrozenModel
+    '''
+    arrays = np.load(path)
+    graph = json.loads(str(arrays['graph']))
+    if graph['version'] != formatVersion:
+        raise ValueError('Unsupported frozen model version %s' % graph['version'])
+
+    def resolve(specs):
+        for spec in specs:
+            for key, value in spec.items():
+                if isinstance(value, dict) and 'array' in value:
+                    spec[key] = arrays[value['array']]
+        return specs
+
+    return FrozenModel(resolve(graph['layers']), resolve(graph['connections']), threads)
+
+
+class FrozenModel(object):
+    '''
+    Runs the feedforward pass of an exported network with NumPy, matching the compiled inference graph
+    '''
+    def __init__(self, layers, connections, threads=1):
+        self.layers = layers
+        self.connections = connections
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.outputLayers = [layer['name'] for layer in layers if layer['ifOutput']]
+        self.outputLayer = self.outputLayers[0]
+        # Inputs are cast once to the dtype the network was trained with
+        weights = [connection['w'] for connection in connections if 'w' in connection]
+        self.dtype = weights[0].dtype if weights else np.float32
+
+    def predict(self, x):
+        '''
+        :param x: inputs (examples x input neurons), any number of examples
+        :return: output of the output layer
+        '''
+        x = np.asarray(x, dtype=self.dtype)
+        return kernels.forward(self.layers, self.connections, x, pool=self.pool)[self.outputLayer]
+
+    def predictAll(self, x):
+        '''
+        :param x: inputs (examples x input neurons), any number of examples
+        :return: list with the output of every output layer, in feedforward order (as Network.outputLayers)
+        '''
+        x = np.asarray(x, dtype=self.dtype)
+        outputs = kernels.forward(self.layers, self.connections, x, pool=self.pool)
+        return [outputs[name] for name in self.outputLayers]
+
+    def predictClasses(self, x):
+        return np.argmax(self.predict(x), axis=1)
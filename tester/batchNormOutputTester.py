@@ -0,0 +1,54 @@
+__author__ = 'daksh'
+
+'''
+Trains a network whose softmax output layer is a BatchNormLayer through Network.fit, which takes the fused
+softmax/NLL cost on the normalized input. Checks that gamma and beta of the output layer are trained and that the
+training step counts correct predictions on the normalized logits, i.e. agrees with the argmax of the output.
+Exits with an error otherwise.
+'''
+
+import sys
+import numpy as np
+import theano
+import theano.tensor as T
+from deepLearningLibrary.network import Network
+from deepLearningLibrary.layers import *
+
+miniBatchSize = 10
+rng = np.random.RandomState(1234)
+
+def randomData(numExamples):
+    x = theano.shared(np.asarray(rng.rand(numExamples, 20), dtype=theano.config.floatX), borrow=True)
+    y = theano.shared(np.asarray(rng.randint(0, 5, numExamples), dtype='int32'), borrow=True)
+    return x, y
+
+net = Network('batch norm output')
+l1 = InputLayer(inputShape=(20,))
+l2 = ActivationLayer(inputShape=(16,), passFunction='tanh')
+l3 = BatchNormLayer(inputShape=(5,), passFunction='softmax', ifOutput=True, lossFunction='negativeLogLikelihood')
+net.connectDense(l1, l2)
+net.connectDense(l2, l3)
+net.compile(miniBatchSize)
+
+failed = False
+if not l3.hasFusedSoftmaxCost():
+    print('The batch normalized softmax output does not take the fused cost')
+    failed = True
+
+gamma, beta = l3.gamma.get_value(), l3.beta.get_value()
+training_x, training_y = randomData(100)
+net.fit((training_x, training_y), 2, 0.5, randomData(50), randomData(50), training_metrics=True)
+if np.allclose(l3.gamma.get_value(), gamma) or np.allclose(l3.beta.get_value(), beta):
+    print('gamma and beta of the output layer were not trained')
+    failed = True
+
+# Training graph, with minibatch statistics: the fused count must agree with the output probabilities
+counts = theano.function([], [l3.correctCount(net.y), T.sum(T.eq(net.y, l3.y_out))],
+                         givens={net.x: training_x[:miniBatchSize], net.y: training_y[:miniBatchSize]})
+fusedCount, outputCount = counts()
+print('correct predictions in a training mini-batch: %d fused, %d from the output' % (fusedCount, outputCount))
+if fusedCount != outputCount:
+    failed = True
+
+if failed:
+    sys.exit(1)
@@ -0,0 +1,53 @@
+__author__ = 'daksh'
+
+'''
+Parity check of the im2col convolution of the NumPy runtime (kernels.conv2d) against scipy.signal.convolve2d, which
+like theano.tensor.nnet.conv.conv2d is a true convolution. Covers several channel counts, filter sizes, strides and
+zero paddings; exits with an error if any output differs by more than the tolerance.
+'''
+
+import sys
+import numpy as np
+from scipy.signal import convolve2d
+from deepLearningLibrary import kernels
+
+tolerance = 1e-4
+
+def referenceConvolution(x, w, b, stride, padding):
+    # Sum over the input channels of 'valid' 2D convolutions, subsampled by the stride
+    x = kernels.pad2d(x, padding)
+    outputs = []
+    for image in x:
+        maps = []
+        for filterIndex in range(w.shape[0]):
+            full = sum([convolve2d(image[channel], w[filterIndex, channel], mode='valid')
+                        for channel in range(w.shape[1])])
+            maps.append(full[::stride[0], ::stride[1]] + b[filterIndex])
+        outputs.append(maps)
+    return np.array(outputs)
+
+
+rng = np.random.RandomState(1234)
+cases = [# (images, channels, height, width), (filters, filterHeight, filterWidth), stride, padding
+         ((4, 1, 8, 8), (3, 3, 3), (1, 1), 0),
+         ((4, 3, 9, 7), (5, 3, 3), (1, 1), 1),
+         ((2, 2, 12, 12), (4, 5, 5), (2, 2), 2),
+         ((3, 4, 10, 11), (2, 2, 4), (1, 2), 0),
+         ((2, 1, 6, 6), (1, 1, 1), (1, 1), 0)]
+
+failed = False
+for (numImages, channels, height, width), (numFilters, filterHeight, filterWidth), stride, padding in cases:
+    x = rng.randn(numImages, channels, height, width).astype('float32')
+    w = rng.randn(numFilters, channels, filterHeight, filterWidth).astype('float32')
+    b = rng.randn(numFilters).astype('float32')
+
+    out = kernels.conv2d(x, w, b, stride, padding)
+    reference = referenceConvolution(x, w, b, stride, padding)
+    error = np.max(np.abs(out - reference)) if out.shape == reference.shape else np.inf
+    print('input %s, filters %s, stride %s, padding %d: max error %g' % (x.shape, w.shape, stride, padding, error))
+    if error > tolerance:
+        failed = True
+
+if failed:
+    print('kernels.conv2d differs from scipy.signal.convolve2d')
+    sys.exit(1)
@@ -0,0 +1,74 @@
+__author__ = 'daksh'
+
+'''
+Round trip of a frozen model: a dense network (input normalization, batch normalization, one-to-one and dense
+connections) and a convolution/max pooling network are compiled and trained for an epoch, exported with
+Network.export and loaded back with runtime.loadFrozenModel. The loaded model must reproduce the predictions of the
+compiled Theano inference graph within tolerance. Exits with an error otherwise.
+'''
+
+import os
+import sys
+import tempfile
+import numpy as np
+import theano
+from deepLearningLibrary.network import Network
+from deepLearningLibrary.layers import *
+from deepLearningLibrary.runtime import loadFrozenModel
+
+miniBatchSize = 10
+rng = np.random.RandomState(1234)
+
+def randomData(numExamples, numInputs, numClasses):
+    x = theano.shared(np.asarray(rng.randint(0, 256, size=(numExamples, numInputs)), dtype=theano.config.floatX),
+                      borrow=True)
+    y = theano.shared(np.asarray(rng.randint(0, numClasses, numExamples), dtype='int32'), borrow=True)
+    return x, y
+
+def denseNetwork():
+    net = Network('frozen dense')
+    l1 = InputLayer(inputShape=(64,), scale=1/255.0, mean=0.5*np.ones(64))
+    l2 = BatchNormLayer(inputShape=(20,), passFunction='tanh')
+    l3 = ActivationLayer(inputShape=(20,), passFunction='sigmoid')
+    l4 = ActivationLayer(inputShape=(5,), passFunction='softmax', ifOutput=True, lossFunction='negativeLogLikelihood')
+    net.connectDense(l1, l2)
+    net.connectOneToOne(l2, l3)
+    net.connectDense(l3, l4)
+    return net
+
+def convolutionNetwork():
+    net = Network('frozen convolution')
+    l1 = InputLayer(inputShape=(1,8,8), scale=1/255.0)
+    l2 = ActivationLayer(inputShape=(4,8,8), passFunction='relu')
+    l3 = ActivationLayer(inputShape=(4,4,4), passFunction='passthrough')
+    l4 = ActivationLayer(inputShape=(5,), passFunction='softmax', ifOutput=True, lossFunction='negativeLogLikelihood')
+    net.connectConvolution(l1, l2, input_shape=(1,8,8), filter_shape=(4,1,3,3), stride_length=(1,1), zero_padding=1)
+    net.connectMaxPool(l2, l3, poolSize=(2,2))
+    net.connectDense(l3, l4)
+    return net
+
+failed = False
+for net in [denseNetwork(), convolutionNetwork()]:
+    net.compile(miniBatchSize)
+    net.fit(randomData(100, 64, 5), 1, 0.1, randomData(20, 64, 5), randomData(20, 64, 5))
+
+    # 25 rows, so the last minibatch of the Theano prediction is padded
+    x = rng.randint(0, 256, size=(25, 64)).astype(theano.config.floatX)
+    expected = net.predict(x)
+
+    handle, path = tempfile.mkstemp(suffix='.npz')
+    os.close(handle)
+    try:
+        net.export(path)
+        predictions = loadFrozenModel(path).predict(x)
+    finally:
+        os.remove(path)
+
+    error = np.max(np.abs(predictions - expected))
+    print('%s: max difference between the frozen model and the compiled network: %g' % (net.name, error))
+    if predictions.shape != expected.shape or not np.allclose(predictions, expected, rtol=1e-4, atol=1e-5):
+        print('%s: the exported frozen model does not reproduce the compiled network' % net.name)
+        failed = True
+
+if failed:
+    sys.exit(1)
@@ -0,0 +1,40 @@
+__author__ = 'daksh'
+
+'''
+Import time benchmark. Importing the library to build or inspect a topology, or to run an exported model, must not
+import Theano. Each import is timed in a fresh interpreter; exits with an error if Theano gets imported or an import
+takes longer than the budget.
+'''
+
+import subprocess
+import sys
+
+modules = ['deepLearningLibrary.network', 'deepLearningLibrary.layers', 'deepLearningLibrary.connections',
+           'deepLearningLibrary.runtime']
+budget = 0.5    # seconds
+repeats = 5
+
+snippet = ("import sys, time\n"
+           "tic = time.time()\n"
+           "import %s\n"
+           "print('%%f %%d' %% (time.time() - tic, 'theano' in sys.modules))\n")
+
+failed = False
+for module in modules:
+    timings = []
+    for repeat in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', snippet % module])
+        seconds, theanoImported = output.split()
+        timings.append(float(seconds))
+        if int(theanoImported):
+            print('%s imports theano' % module)
+            failed = True
+            break
+    best = min(timings)
+    print('%s: best of %d imports %.3f s' % (module, len(timings), best))
+    if best > budget:
+        print('%s takes longer than %.1f s to import' % (module, budget))
+        failed = True
+
+if failed:
+    sys.exit(1)
@@ -121,23 +121,157 @@ def fBetaScore(y_true, y_pred, beta=1):
 
 
 
-        # If there are no true positives, fix the F score at 0 like sklearn.
-        if (T.sum(T.round(T.clip(y_true, 0, 1))) == 0):
-            print "no true positives found"
-            return 0
-
-
         p = precision(y_true, y_pred)
         r = recall(y_true, y_pred)
         bb = beta ** 2
-        fbeta_score = (1 + bb) * (p * r) / ((bb * p + r ))
-        return fbeta_score
+        fbeta_score = (1 + bb) * (p * r) / ((bb * p + r ) + eps)
+
+        # If there are no true positives, fix the F score at 0 like sklearn.
+        # This has to be decided on the graph, y_true is symbolic here
+        return T.switch(T.eq(T.sum(T.round(T.clip(y_true, 0, 1))), 0), 0., fbeta_score)
 
     
 def fmeasure(y_true, y_pred):
     '''Calculates the f-measure, the harmonic mean of precision and recall.
     '''
     return fBetaScore(y_true, y_pred, beta=1)
+
+
+'''
+Streaming metrics. The functions above score a single minibatch tensor, the classes below keep
+sufficient statistics in NumPy so that dataset level scores are exact after one pass over the
+minibatches. Accumulators filled in different processes can be combined with merge().
+'''
+
+class ConfusionMatrix(object):
+    '''Accumulates a confusion matrix (rows are true classes, columns are predictions) and derives
+    accuracy, precision, recall, f-beta score and the Matthews correlation coefficient from it.
+    '''
+    def __init__(self, numOfClasses):
+        self.numOfClasses = numOfClasses
+        self.matrix = np.zeros((numOfClasses, numOfClasses), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        '''
+        :param y_true: true class of each example
+        :param y_pred: predicted class of each example, or class probabilities (examples x classes)
+        '''
+        y_pred = np.asarray(y_pred)
+        if y_pred.ndim == 2:
+            y_pred = np.argmax(y_pred, axis=1)
+        y_true = np.asarray(y_true).ravel().astype(np.int64)
+        y_pred = y_pred.ravel().astype(np.int64)
+
+        # One bincount over flattened (true, predicted) pairs instead of a loop over examples
+        counts = np.bincount(y_true * self.numOfClasses + y_pred, minlength=self.numOfClasses ** 2)
+        self.matrix += counts.reshape((self.numOfClasses, self.numOfClasses))
+        return self
+
+    def merge(self, other):
+        self.matrix += other.matrix
+        return self
+
+    def reset(self):
+        self.matrix[...] = 0
+
+    def accuracy(self):
+        return np.trace(self.matrix) / float(max(self.matrix.sum(), 1))
+
+    def average(self, perClass, truePositives, denominators, average):
+        '''
+        :param average: None for per class scores, 'macro', 'micro' or 'binary' (class 1 is positive)
+        '''
+        if average is None:
+            return perClass
+        elif average == 'macro':
+            return np.mean(perClass)
+        elif average == 'micro':
+            return truePositives.sum() / (denominators.sum() + eps)
+        elif average == 'binary':
+            return perClass[1]
+        raise ValueError('Unknown average %s' % average)
+
+    def precision(self, average='macro'):
+        truePositives = np.diag(self.matrix).astype(np.float64)
+        predictedPositives = self.matrix.sum(axis=0)
+        return self.average(truePositives / (predictedPositives + eps), truePositives, predictedPositives, average)
+
+    def recall(self, average='macro'):
+        truePositives = np.diag(self.matrix).astype(np.float64)
+        possiblePositives = self.matrix.sum(axis=1)
+        return self.average(truePositives / (possiblePositives + eps), truePositives, possiblePositives, average)
+
+    def fBetaScore(self, beta=1, average='macro'):
+        if beta < 0:
+            raise ValueError('The lowest choosable beta is zero (only precision).')
+        bb = beta ** 2
+        if average == 'micro':
+            p = self.precision('micro')
+            r = self.recall('micro')
+            return (1 + bb) * p * r / (bb * p + r + eps)
+
+        p = self.precision(None)
+        r = self.recall(None)
+        # Classes without true positives get a score of 0 like sklearn
+        perClass = (1 + bb) * p * r / (bb * p + r + eps)
+        return self.average(perClass, None, None, average)
+
+    def fmeasure(self, average='macro'):
+        return self.fBetaScore(beta=1, average=average)
+
+    def matthewsCorrelation(self):
+        '''Multiclass Matthews correlation coefficient, equal to the usual one for two classes'''
+        matrix = self.matrix.astype(np.float64)
+        correct = np.trace(matrix)
+        total = matrix.sum()
+        predicted = matrix.sum(axis=0)
+        actual = matrix.sum(axis=1)
+
+        numerator = correct * total - np.dot(predicted, actual)
+        denominator = np.sqrt((total ** 2 - np.dot(predicted, predicted)) * (total ** 2 - np.dot(actual, actual)))
+        return numerator / (denominator + eps)
+
+
+class MeanAccumulator(object):
+    '''Accumulates the sum and count of per example values, for metrics that are means over examples'''
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.total += values.sum()
+        self.count += values.size
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def reset(self):
+        self.total = 0.0
+        self.count = 0
+
+    def result(self):
+        return self.total / max(self.count, 1)
+
+
+class KullbackLeiblerDivergence(MeanAccumulator):
+    '''Mean Kullback-Leibler divergence between target and predicted distributions'''
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        return super(KullbackLeiblerDivergence, self).update(
+            np.sum(y_true * np.log((y_true + eps) / (y_pred + eps)), axis=-1))
+
+
+def mergeAccumulators(accumulators):
+    '''Combine accumulators of the same kind, for example one per worker process, into the first one'''
+    merged = accumulators[0]
+    for accumulator in accumulators[1:]:
+        merged.merge(accumulator)
+    return merged
    
    
    
@@ -9,6 +9,7 @@ import numpy as np
 from deepLearningLibrary.network import Network
 from deepLearningLibrary.layers import *
 from deepLearningLibrary.connections import *
+from deepLearningLibrary.datasets import loadCompactSharedDataset
 from theano.tensor.nnet import softmax
 from theano.tensor.nnet import sigmoid
 # import _pickle as cPickle
@@ -136,7 +137,7 @@ def shallow(epochs=5):
 
 
     net6 = Network('Simple Bheja')
-    l1 = InputLayer(inputShape = (784,1))
+    l1 = InputLayer(inputShape = (784,1), **normalization)
     l2 = ActivationLayer(inputShape=(200,1),passFunction='sigmoid')
     # l5 = ActivationLayer(inputShape=(200,1),passFunction='sigmoid')
     l3 = MemoryLayer(inputShape=(100,1),passFunction='sigmoid')
@@ -184,7 +185,7 @@ def shallow(epochs=5):
 
 
     net7 = Network('Test Recurrent')
-    l1 = InputLayer(inputShape = (784,1))
+    l1 = InputLayer(inputShape = (784,1), **normalization)
     l2 = ActivationLayer(inputShape=(200,1),passFunction='sigmoid')
     # l5 = ActivationLayer(inputShape=(80,1),passFunction='sigmoid')
     l3 = ActivationLayer(inputShape=(100,1),passFunction='sigmoid')
@@ -276,7 +277,7 @@ def shallow(epochs=5):
 
 
     net7 = Network('RecurrentCheck')
-    l1 = InputLayer(inputShape = (784,1))
+    l1 = InputLayer(inputShape = (784,1), **normalization)
     l2 = ActivationLayer(inputShape=(200,1),passFunction='sigmoid')
     l3 = ActivationLayer(inputShape=(100,1),passFunction='sigmoid')
     #l3 = MemoryLayer(inputShape=(6,1),passFunction='sigmoid',aggregate_method='concat')
@@ -350,22 +351,11 @@ def shallow(epochs=5):
 
 #### Load the MNIST data
 def load_data_shared(filename="../data/mnist.pkl.gz"):
-    f = gzip.open(filename, 'rb')
-    training_data, validation_data, test_data = cPickle.load(f)
-    print training_data[0][0].shape,training_data[1].shape
-    f.close()
-    def shared(data):
-        """Place the data into shared variables.  This allows Theano to copy
-        the data to the GPU, if one is available.
-        """
-        shared_x = theano.shared(
-            np.asarray(data[0], dtype=theano.config.floatX), borrow=True)
-        shared_y = theano.shared(
-            np.asarray(data[1], dtype=theano.config.floatX), borrow=True)
-        return shared_x, T.cast(shared_y, "int32")
-    return [shared(training_data), shared(validation_data), shared(test_data)]
+    # Converted once into uint8 pixels and labels (see datasets.py), later runs memory-map them. The input layers
+    # scale the pixels on the graph with the returned normalization
+    return loadCompactSharedDataset(filename)
 
 mini_batch_size = 20
-training_data, validation_data, test_data = load_data_shared()
+(training_data, validation_data, test_data), normalization = load_data_shared()
 
 net = shallow(epochs=60)
@@ -0,0 +1,54 @@
+__author__ = 'daksh'
+
+'''
+Trains a small network with a SampledSoftmaxLayer head through Network.fit on random data, with training metrics
+on. Also checks that a training step only changes the output weights and bias of the classes it touched (the true
+classes of the mini-batch and the sampled ones). Exits with an error if a step changes any other column.
+'''
+
+import sys
+import numpy as np
+import theano
+from deepLearningLibrary.network import Network
+from deepLearningLibrary.layers import *
+
+numClasses = 500
+numSamples = 8
+miniBatchSize = 10
+rng = np.random.RandomState(1234)
+
+def randomData(numExamples):
+    x = theano.shared(np.asarray(rng.rand(numExamples, 20), dtype=theano.config.floatX), borrow=True)
+    y = theano.shared(np.asarray(rng.randint(0, numClasses, numExamples), dtype='int32'), borrow=True)
+    return x, y
+
+def sampledNetwork(proposal):
+    net = Network('sampled softmax')
+    l1 = InputLayer(inputShape=(20,))
+    l2 = ActivationLayer(inputShape=(16,), passFunction='tanh')
+    l3 = SampledSoftmaxLayer(inputShape=(numClasses,), numSamples=numSamples, proposal=proposal)
+    net.connectDense(l1, l2)
+    net.connectDense(l2, l3)
+    net.compile(miniBatchSize)
+    return net
+
+failed = False
+for proposal in ['uniform', 'logUniform']:
+    net = sampledNetwork(proposal)
+    net.fit(randomData(100), 2, 0.1, randomData(50), randomData(50), lmbda=0.1, training_metrics=True)
+
+    # One mini-batch of training data, so one step: at most miniBatchSize + numSamples columns change
+    output = net.outputLayer.inConnections[0]
+    w, b = output.w.get_value(), output.b.get_value()
+    net.fit(randomData(miniBatchSize), 1, 0.1, randomData(miniBatchSize), randomData(miniBatchSize), lmbda=0.1)
+    changedWeights = np.flatnonzero(np.any(output.w.get_value() != w, axis=0))
+    changedBias = np.flatnonzero(output.b.get_value()[0] != b[0])
+    print('%s proposal: %d weight and %d bias columns changed by one step' %
+          (proposal, len(changedWeights), len(changedBias)))
+    if len(changedWeights) == 0 or len(changedWeights) > miniBatchSize + numSamples or \
+            not set(changedBias) <= set(changedWeights):
+        failed = True
+
+if failed:
+    print('A training step of the sampled softmax changed columns it did not touch')
+    sys.exit(1)
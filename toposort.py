@@ -1,10 +1,7 @@
 __author__ = 'daksh'
 
-from collections import deque
 from deepLearningLibrary.connections import *
 
-GRAY, BLACK = 0, 1
-
 def constructGraph(layers):
     g = {}
     for i in layers:
@@ -13,20 +10,36 @@ def constructGraph(layers):
     return g
 
 
+def topologicalLevels(graph):
+    '''
+    Iterative (Kahn) topological sort that groups the nodes into dependency levels. All predecessors of a node are
+    in earlier levels, so the nodes of one level can be computed independently of each other.
+    :param graph: dictionary node -> list of successors
+    :return: list of levels, each a list of nodes
+    '''
+    inDegree = dict((node, 0) for node in graph)
+    for node in graph:
+        for successor in graph[node]:
+            inDegree[successor] = inDegree.get(successor, 0) + 1
+
+    levels = []
+    current = [node for node in inDegree if inDegree[node] == 0]
+    numVisited = 0
+    while current:
+        levels.append(current)
+        numVisited += len(current)
+        following = []
+        for node in current:
+            for successor in graph.get(node, ()):
+                inDegree[successor] -= 1
+                if inDegree[successor] == 0:
+                    following.append(successor)
+        current = following
+
+    if numVisited != len(inDegree):
+        raise(NetworkNotDAG())
+    return levels
+
+
 def topological(graph):
-    order, enter, state = deque(), set(graph), {}
-
-    def dfs(node):
-        state[node] = GRAY
-        for k in graph.get(node, ()):
-            sk = state.get(k, None)
-            if sk == GRAY:
-                raise(NetworkNotDAG())
-            if sk == BLACK: continue
-            enter.discard(k)
-            dfs(k)
-        order.appendleft(node)
-        state[node] = BLACK
-
-    while enter: dfs(enter.pop())
-    return list(order)
\ No newline at end of file
+    return [node for level in topologicalLevels(graph) for node in level]
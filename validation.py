@@ -0,0 +1,165 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+import Queue
+import cPickle
+import numpy as np
+from deepLearningLibrary.runtime import FrozenModel
+from deepLearningLibrary.exceptions import *
+
+'''
+Asynchronous validation. A worker process scores snapshots of the weights (see Network.graphSpecification) on the
+validation and test data with the NumPy runtime, while the trainer keeps stepping. Results come back in the order
+the snapshots were taken.
+
+The worker is a fresh interpreter, not a fork of the trainer: forking after BLAS has started its thread pool can
+deadlock the child (OpenBLAS). Data, snapshots and results are pickled over its stdin and stdout.
+'''
+
+def hostArray(data):
+    '''
+    :param data: shared variable or symbolic expression of shared variables (e.g. labels cast to int32)
+    :return: its value as a NumPy array
+    '''
+    if hasattr(data, 'get_value'):
+        return data.get_value(borrow=True)
+    return data.eval()
+
+
+def headAccuracies(model, x, ys, chunkSize=1024):
+    '''
+    :return: accuracy of every output layer of the FrozenModel on (x, ys)
+    '''
+    correct = np.zeros(len(ys))
+    for start in range(0, x.shape[0], chunkSize):
+        outputs = model.predictAll(x[start:start+chunkSize])
+        for head, (output, y) in enumerate(zip(outputs, ys)):
+            correct[head] += np.sum(np.argmax(output, axis=1) == y[start:start+chunkSize])
+    return list(correct / x.shape[0])
+
+
+def validationWorker(tasks, results):
+    '''
+    :param tasks: file the validation and test data, then the snapshots and finally None are read from
+    :param results: file the results are written to
+    '''
+    validation, test = cPickle.load(tasks)
+    # Same rule as the trainer: test data is only scored for a new best validation accuracy
+    best = 0.0
+    while True:
+        try:
+            task = cPickle.load(tasks)
+        except EOFError:
+            # The trainer went away without closing the validator
+            break
+        if task is None:
+            break
+        epoch, iteration, layers, connections = task
+        try:
+            model = FrozenModel(layers, connections)
+            result = {'epoch': epoch, 'iteration': iteration, 'headAccuracies': headAccuracies(model, *validation)}
+            if np.mean(result['headAccuracies']) > best:
+                best = np.mean(result['headAccuracies'])
+                if test is not None:
+                    result['testAccuracy'] = np.mean(headAccuracies(model, *test))
+        except Exception:
+            result = {'epoch': epoch, 'iteration': iteration, 'error': traceback.format_exc()}
+        cPickle.dump(result, results, protocol=cPickle.HIGHEST_PROTOCOL)
+        results.flush()
+
+
+class AsyncValidator(object):
+    '''
+    Owns the validation worker process. The validation and test data are handed over once, when the worker starts
+    '''
+    def __init__(self, validation, test=None, maxPending=2):
+        '''
+        :param validation: (x, list of labels per output layer) as NumPy arrays
+        :param test: same for the test data, or None
+        :param maxPending: snapshots waiting to be scored before submit blocks, which bounds the snapshot memory
+        '''
+        environment = dict(os.environ)
+        # The package has to be importable from the worker, whatever its working directory
+        packageParent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment['PYTHONPATH'] = os.pathsep.join([packageParent] + [path for path in
+                                                                       [environment.get('PYTHONPATH')] if path])
+        self.process = subprocess.Popen([sys.executable, '-m', 'deepLearningLibrary.validation'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment)
+        cPickle.dump((validation, test), self.process.stdin, protocol=cPickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+
+        # Results are read by a thread, so that the trainer can check for them without blocking
+        self.results = Queue.Queue()
+        self.reader = threading.Thread(target=self.readResults)
+        self.reader.daemon = True
+        self.reader.start()
+        self.maxPending = maxPending
+        self.pending = 0
+        self.received = []
+
+    def readResults(self):
+        while True:
+            try:
+                self.results.put(cPickle.load(self.process.stdout))
+            except EOFError:
+                break
+
+    def receive(self):
+        # Waits for the next result, as long as the worker is alive
+        while True:
+            try:
+                result = self.results.get(True, 1.0)
+                break
+            except Queue.Empty:
+                if self.process.poll() is not None and self.results.empty():
+                    raise(ValidationWorkerFailed("The validation worker exited"))
+        self.pending -= 1
+        if 'error' in result:
+            raise(ValidationWorkerFailed(result['error']))
+        self.received.append(result)
+
+    def submit(self, epoch, iteration, layers, connections):
+        while self.pending >= self.maxPending:
+            self.receive()
+        cPickle.dump((epoch, iteration, layers, connections), self.process.stdin,
+                     protocol=cPickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+        self.pending += 1
+
+    def poll(self, block=False):
+        '''
+        :param block: wait for the results of all submitted snapshots
+        :return: results received since the last poll
+        '''
+        if block:
+            while self.pending > 0:
+                self.receive()
+        else:
+            while self.pending > 0 and not self.results.empty():
+                self.receive()
+        received, self.received = self.received, []
+        return received
+
+    def close(self):
+        # Also called when training failed, the worker may have exited already
+        if self.process.poll() is None:
+            try:
+                cPickle.dump(None, self.process.stdin, protocol=cPickle.HIGHEST_PROTOCOL)
+                self.process.stdin.flush()
+            except IOError:
+                pass
+        self.process.stdin.close()
+        self.process.wait()
+        self.reader.join()
+
+
+if __name__ == '__main__':
+    # An interrupt (Ctrl-C) reaches the whole process group, the trainer closes the worker in that case
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Results go to the original stdout, anything printed while scoring goes to stderr
+    results = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    validationWorker(os.fdopen(0, 'rb'), results)